@@ -0,0 +1,461 @@
+"""Замеры производительности модуля фитнес-трекера.
+
+Запуск: `python benchmark.py --sizes 1,1000,100000 --save baseline.json`,
+затем `python benchmark.py --compare baseline.json` сообщает о замедлениях
+и завершается с кодом 1, если они больше порога `--threshold`.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import homework
+
+PACKAGES = [
+    ('SWM', [720, 1, 80, 25, 40]),
+    ('RUN', [15000, 1, 75]),
+    ('WLK', [9000, 1, 75, 180]),
+]
+SEED = None
+
+
+def make_packages(size: int) -> list:
+    """Повторить образцовые пакеты до нужного размера.
+
+    С `--seed` пакеты берутся из `homework.generate_packages()`.
+    """
+    if SEED is not None:
+        return list(homework.generate_packages(size, SEED))
+    return [PACKAGES[i % len(PACKAGES)] for i in range(size)]
+
+
+def measure_memory(build, size: int) -> float:
+    """Вернуть количество байт на тренировку для результата `build()`."""
+    packages = make_packages(size)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build(packages)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return (after - before) / size
+
+
+def build_objects(packages: list) -> list:
+    return [homework.read_package(*package) for package in packages]
+
+
+def build_slotted(packages: list) -> list:
+    return [homework.read_package(*package, homework.SLOTTED_WORKOUT_TYPES)
+            for package in packages]
+
+
+def build_batch(packages: list) -> homework.TrainingBatch:
+    return homework.TrainingBatch.from_packages(packages)
+
+
+def build_batch_single(packages: list) -> homework.TrainingBatch:
+    return homework.TrainingBatch.from_packages(packages, 'single')
+
+
+MEMORY_CASES = {
+    'Training': build_objects,
+    'SlottedTraining': build_slotted,
+    'TrainingBatch': build_batch,
+    'TrainingBatch(single)': build_batch_single,
+}
+
+
+def bench_memory(size: int = 100000) -> dict:
+    """Байт на тренировку для каждого представления."""
+    return {name: measure_memory(build, size)
+            for name, build in MEMORY_CASES.items()}
+
+
+def without_cache(cls: type) -> type:
+    """Вариант класса тренировки, который не запоминает показатели."""
+    return type(cls.__name__, (cls,), {
+        '_metrics': property(lambda self: None, lambda self, value: None)
+    })
+
+
+def count_metric_calls(training: homework.Training) -> int:
+    """Сколько раз формулы показателей считаются в `show_training_info()`."""
+    codes = {training.KERNEL.__code__}
+    calls = 0
+
+    def profile(frame, event, arg):
+        nonlocal calls
+        if event == 'call' and frame.f_code in codes:
+            calls += 1
+    sys.setprofile(profile)
+    try:
+        training.show_training_info()
+    finally:
+        sys.setprofile(None)
+    return calls
+
+
+def bench_metric_calls() -> dict:
+    """Вызовы формул на отчёт без кэша и с кэшем показателей."""
+    result = {}
+    for workout_type, data in PACKAGES:
+        uncached = without_cache(homework.WORKOUT_TYPES[workout_type])(*data)
+        cached = homework.read_package(workout_type, data)
+        result[workout_type] = (count_metric_calls(uncached),
+                                count_metric_calls(cached))
+    return result
+
+
+def bench_parallel(size: int = 100000, workers: tuple = None) -> dict:
+    """Время обработки пакетов в одном процессе и в `process_parallel()`."""
+    workers = workers or tuple(
+        sorted({1, 2, os.cpu_count() or 1, 2 * (os.cpu_count() or 1)})
+    )
+    packages = make_packages(size)
+    start = time.perf_counter()
+    homework.process_shard(packages)
+    result = {0: time.perf_counter() - start}
+    for count in workers:
+        start = time.perf_counter()
+        for _ in homework.process_parallel(packages, workers=count):
+            pass
+        result[count] = time.perf_counter() - start
+    return result
+
+
+def build_messages(packages: list) -> list:
+    return [homework.read_package(*package).show_training_info()
+            for package in packages]
+
+
+def build_columns(packages: list) -> tuple:
+    return homework.read_packages_columns(packages)
+
+
+def run_read_package(packages: list) -> None:
+    read_package = homework.read_package
+    for workout_type, data in packages:
+        read_package(workout_type, data)
+
+
+def run_read_show(packages: list) -> None:
+    read_package = homework.read_package
+    for workout_type, data in packages:
+        read_package(workout_type, data).show_training_info()
+
+
+def run_spent_calories(trainings: list) -> None:
+    for training in trainings:
+        training.get_spent_calories()
+
+
+def run_show_training_info(trainings: list) -> None:
+    for training in trainings:
+        training.show_training_info()
+
+
+def run_kernel(packages: list) -> None:
+    types = homework.WORKOUT_TYPES
+    for workout_type, data in packages:
+        types[workout_type].KERNEL(*data)
+
+
+def run_get_message(messages: list) -> None:
+    for message in messages:
+        message.get_message()
+
+
+def run_main(packages: list) -> None:
+    with contextlib.redirect_stdout(io.StringIO()):
+        for workout_type, data in packages:
+            homework.main(homework.read_package(workout_type, data))
+
+
+def run_process_batch(columns: tuple) -> None:
+    homework.process_batch(*columns)
+
+
+def run_process_batch_folded(columns: tuple) -> None:
+    homework.process_batch(*columns, exact=False)
+
+
+def run_batch_compute(batch: homework.TrainingBatch) -> None:
+    batch.compute()
+
+
+def build_history(packages: list) -> homework.UserHistory:
+    history = homework.UserHistory(75, 180)
+    history.extend(*homework.read_packages_columns(packages))
+    return history
+
+
+def run_update_profile(history: homework.UserHistory) -> None:
+    history.update_profile(weight=80)
+
+
+def only(workout_type: str):
+    """Подготовка, оставляющая пакеты одного вида тренировки."""
+    data = dict(PACKAGES)[workout_type]
+
+    def setup(packages: list) -> list:
+        return build_objects([(workout_type, data)] * len(packages))
+    return setup
+
+
+TIME_CASES = {
+    'read_package': (list, run_read_package),
+    'read_package+show_training_info': (list, run_read_show),
+    'Running.get_spent_calories': (only('RUN'), run_spent_calories),
+    'SportsWalking.get_spent_calories': (only('WLK'), run_spent_calories),
+    'Swimming.get_spent_calories': (only('SWM'), run_spent_calories),
+    'show_training_info': (build_objects, run_show_training_info),
+    'KERNEL': (list, run_kernel),
+    'InfoMessage.get_message': (build_messages, run_get_message),
+    'main': (list, run_main),
+    'process_batch': (build_columns, run_process_batch),
+    'process_batch(exact=False)': (build_columns, run_process_batch_folded),
+    'TrainingBatch.compute': (build_batch, run_batch_compute),
+    'TrainingBatch.compute(single)': (build_batch_single, run_batch_compute),
+    'UserHistory.update_profile': (build_history, run_update_profile),
+}
+
+
+MIN_TIME = 0.2
+
+
+def _autorange(number: int) -> int:
+    """Следующее число запусков в ряду 1, 2, 5, 10, 20, 50, ..."""
+    digits = len(str(number)) - 1
+    step = number // 10 ** digits
+    return (2 if step == 1 else 5 if step == 2 else 10) * 10 ** digits
+
+
+def measure_time(setup, run, size: int, repeat: int = 3,
+                 min_time: float = MIN_TIME) -> float:
+    """Лучшее время `run()` в наносекундах на пакет.
+
+    Подготовка повторяется перед каждым запуском, чтобы кэш показателей
+    тренировок не искажал результат, и в замер не входит. Как
+    в `timeit.Timer.autorange()`, число запусков в замере растёт, пока
+    замер не займёт `min_time` секунд, а время делится на все
+    посчитанные в нём пакеты.
+    """
+    packages = make_packages(size)
+    number = 1
+    best = float('inf')
+    for _ in range(repeat):
+        while True:
+            states = [setup(packages) for _ in range(number)]
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                for state in states:
+                    run(state)
+                elapsed = time.perf_counter() - start
+            finally:
+                gc.enable()
+            del states
+            if elapsed >= min_time:
+                break
+            number = _autorange(number)
+        best = min(best, elapsed / number)
+    return best / size * 1e9
+
+
+def bench_time(sizes: list, cases: list = None, repeat: int = 3,
+               min_time: float = MIN_TIME) -> dict:
+    """Наносекунды на пакет для каждого случая и размера батча."""
+    return {name: {str(size): measure_time(*TIME_CASES[name], size, repeat,
+                                           min_time)
+                   for size in sizes}
+            for name in cases or TIME_CASES}
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    """Найти замеры, которые медленнее базовых больше чем на `threshold`."""
+    regressions = []
+    for name, timings in result.items():
+        for size, value in timings.items():
+            base = baseline.get(name, {}).get(size)
+            if base and value > base * (1 + threshold):
+                regressions.append((name, size, base, value))
+    return regressions
+
+
+def bench_dispatch(counts: tuple = (3, 30, 300, 3000),
+                   size: int = 100000) -> dict:
+    """Время `read_package()` в зависимости от числа видов тренировок."""
+    packages = make_packages(size)
+    result = {}
+    for count in counts:
+        types = dict(homework.WORKOUT_TYPES)
+        for i in range(count - len(types)):
+            types[f'X{i:04d}'] = homework.Running
+        start = time.perf_counter()
+        for workout_type, data in packages:
+            homework.read_package(workout_type, data, types)
+        result[count] = (time.perf_counter() - start) / size * 1e9
+    return result
+
+
+def bench_shared(size: int = 20000, workers: int = None) -> dict:
+    """`process_shared()` против отправки каждого пакета в процесс."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    packages = make_packages(size)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(homework.process_shard, [package])
+                   for package in packages]
+        for future in futures:
+            future.result()
+    result = {'submit': time.perf_counter() - start}
+    start = time.perf_counter()
+    sources = [packages[k::workers] for k in range(workers)]
+    for _ in homework.process_shared(sources, workers):
+        pass
+    result['shared_memory'] = time.perf_counter() - start
+    return result
+
+
+def bench_generator(size: int = 100000) -> dict:
+    """Пакетов в секунду у генератора и при записи сгенерированных файлов."""
+    result = {}
+    for pool in (0, 1024):
+        start = time.perf_counter()
+        for _ in homework.generate_packages(size, pool=pool):
+            pass
+        result[f'generate_packages(pool={pool})'] = (
+            size / (time.perf_counter() - start)
+        )
+    packages = list(homework.generate_packages(size))
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in ('ndjson', 'csv', 'bin'):
+            path = os.path.join(directory, f'packages.{extension}')
+            start = time.perf_counter()
+            homework.save_packages(packages, path)
+            result[f'save_packages(.{extension})'] = (
+                size / (time.perf_counter() - start)
+            )
+    return result
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1,1000,100000',
+                        help='размеры батчей через запятую, до 10000000')
+    parser.add_argument('--cases', default='',
+                        help='случаи через запятую, по умолчанию все')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+                        help='минимальная длительность одного замера, с')
+    parser.add_argument('--save', help='сохранить результат как базовый')
+    parser.add_argument('--compare', help='сравнить с базовым результатом')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--seed', type=int,
+                        help='мерить на сгенерированных пакетах')
+    parser.add_argument('--memory', action='store_true',
+                        help='замерить память на тренировку')
+    parser.add_argument('--calls', action='store_true',
+                        help='посчитать вызовы формул на отчёт')
+    parser.add_argument('--parallel', action='store_true',
+                        help='сравнить с process_parallel()')
+    parser.add_argument('--shared', action='store_true',
+                        help='сравнить process_shared() с submit на пакет')
+    parser.add_argument('--dispatch', action='store_true',
+                        help='read_package() при росте числа видов')
+    parser.add_argument('--generator', action='store_true',
+                        help='скорость генератора пакетов')
+    return parser.parse_args(argv)
+
+
+def report_memory() -> None:
+    for name, per_workout in bench_memory().items():
+        print(f'{name}: {per_workout:.1f} байт на тренировку')
+
+
+def report_calls() -> None:
+    for workout_type, (before, after) in bench_metric_calls().items():
+        print(f'{workout_type}: {before} -> {after} вызовов формул '
+              f'на show_training_info()')
+
+
+def report_dispatch() -> None:
+    for count, value in bench_dispatch().items():
+        print(f'read_package, {count} видов: {value:.0f} нс/пакет')
+
+
+def report_shared() -> None:
+    for mode, seconds in bench_shared().items():
+        print(f'{mode}: {seconds:.3f} с')
+
+
+def report_generator() -> None:
+    for name, rate in bench_generator().items():
+        print(f'{name}: {rate:.0f} пакетов/с')
+
+
+def report_parallel() -> None:
+    timings = bench_parallel()
+    serial = timings.pop(0)
+    print(f'1 процесс без пула: {serial:.3f} с')
+    for count, seconds in timings.items():
+        print(f'{count} процессов: {seconds:.3f} с, '
+              f'ускорение {serial / seconds:.2f}x')
+
+
+EXTRA_REPORTS = {
+    'memory': report_memory,
+    'calls': report_calls,
+    'dispatch': report_dispatch,
+    'shared': report_shared,
+    'parallel': report_parallel,
+    'generator': report_generator,
+}
+
+
+def report_extra(args: argparse.Namespace) -> None:
+    for name, report in EXTRA_REPORTS.items():
+        if getattr(args, name):
+            report()
+
+
+def run(argv: list = None) -> int:
+    """Запустить замеры и вернуть код завершения."""
+    global SEED
+    args = parse_args(argv)
+    SEED = args.seed
+    sizes = [int(size) for size in args.sizes.split(',')]
+    cases = [name for name in args.cases.split(',') if name]
+    result = bench_time(sizes, cases, args.repeat, args.min_time)
+    for name, timings in result.items():
+        for size, value in timings.items():
+            print(f'{name} [{size}]: {value:.0f} нс/пакет')
+    report_extra(args)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as stream:
+            json.dump(result, stream, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as stream:
+            regressions = compare(result, json.load(stream), args.threshold)
+        for name, size, base, value in regressions:
+            print(f'Замедление {name} [{size}]: '
+                  f'{base:.0f} -> {value:.0f} нс/пакет')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
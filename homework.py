@@ -1,5 +1,40 @@
+import argparse
+import ast
+import contextlib
+import csv
+import functools
+import heapq
+import itertools
+import json
+import math
+import mmap
+import operator
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from fractions import Fraction
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional
+
+if TYPE_CHECKING:
+    import asyncio
+    import random
+    from concurrent.futures import Executor
+
+
 class InfoMessage:
     """Информационное сообщение о тренировке."""
+    FIELDS: tuple = ('training_type', 'duration', 'distance',
+                     'speed', 'calories')
+    MESSAGE: str = ('Тип тренировки: {}; '
+                    'Длительность: {:.3f} ч.; '
+                    'Дистанция: {:.3f} км; '
+                    'Ср. скорость: {:.3f} км/ч; '
+                    'Потрачено ккал: {:.3f}.')
 
     def __init__(self, training_type: str,
                  duration: float,
@@ -14,11 +49,415 @@ class InfoMessage:
         self.calories = calories
 
     def get_message(self) -> str:
-        return str((f'Тип тренировки: {self.training_type}; '
-                    f'Длительность: {float(self.duration):.3f} ч.; '
-                    f'Дистанция: {float(self.distance):.3f} км; '
-                    f'Ср. скорость: {float(self.speed):.3f} км/ч; '
-                    f'Потрачено ккал: {float(self.calories):.3f}.'))
+        return self.MESSAGE.format(self.training_type, self.duration,
+                                   self.distance, self.speed, self.calories)
+
+
+class LazyInfoMessage(InfoMessage):
+    """Информационное сообщение, которое считает поля при первом обращении.
+
+    При создании запоминаются только параметры тренировки, так что
+    сообщение отражает её состояние на момент создания и не держит
+    ссылку на неё. Каждое поле считается при первом чтении ядром
+    из `METRIC_KERNELS`, только по тем формулам, от которых зависит:
+    чтение дистанции не считает калории. У тренировок без ядер
+    показатели берутся сразу.
+    """
+
+    def __init__(self, training) -> None:
+        self.training_type: str = training.__class__.__name__
+        self.duration: float = training.duration
+        self._kernels: Optional[dict] = training.METRIC_KERNELS
+        if self._kernels is None:
+            self.distance, self.speed, self.calories = training.get_metrics()
+        else:
+            self._arguments: tuple = training.KERNEL_ARGUMENTS(training)
+
+    @functools.cached_property
+    def distance(self) -> float:
+        return self._kernels['distance'](*self._arguments)
+
+    @functools.cached_property
+    def speed(self) -> float:
+        return self._kernels['speed'](*self._arguments)
+
+    @functools.cached_property
+    def calories(self) -> float:
+        return self._kernels['calories'](*self._arguments)
+
+
+MESSAGE_FORMATS: dict = {
+    'text': InfoMessage.MESSAGE + '\n',
+    'csv': '{},{!r},{!r},{!r},{!r}\n',
+    'ndjson': ('{{"training_type": "{}", "duration": {!r}, '
+               '"distance": {!r}, "speed": {!r}, "calories": {!r}}}\n'),
+}
+
+MESSAGE_HEADERS: dict = {
+    'csv': ','.join(InfoMessage.FIELDS) + '\n',
+}
+
+
+class _JsonNull:
+    """Значение, которое `{!r}` выводит как JSON `null`."""
+
+    def __repr__(self) -> str:
+        return 'null'
+
+
+_JSON_NULL = _JsonNull()
+
+
+def _json_number(value: float):
+    return value if math.isfinite(value) else _JSON_NULL
+
+
+MESSAGE_CONVERTERS: dict = {
+    'ndjson': _json_number,
+}
+
+
+def render_messages(messages: list, fmt: str = 'text') -> str:
+    """Отформатировать сообщения одним вызовом `str.format()`.
+
+    Шаблон формата повторяется по числу сообщений, а поля всех сообщений
+    подставляются разом, без склейки строк по записям. В NDJSON
+    NaN и бесконечности выводятся как `null`.
+    """
+    convert = MESSAGE_CONVERTERS.get(fmt)
+    if convert is None:
+        fields = itertools.chain.from_iterable(
+            (message.training_type, message.duration, message.distance,
+             message.speed, message.calories)
+            for message in messages
+        )
+    else:
+        fields = itertools.chain.from_iterable(
+            (message.training_type, convert(message.duration),
+             convert(message.distance), convert(message.speed),
+             convert(message.calories))
+            for message in messages
+        )
+    return (MESSAGE_FORMATS[fmt] * len(messages)).format(*fields)
+
+
+def write_messages(messages: Iterable[InfoMessage], stream=None,
+                   fmt: str = 'text', chunk_size: int = 4096) -> int:
+    """Записать сообщения в поток или файловый дескриптор крупными кусками.
+
+    Подходит как `sink` для `run_pipeline()` вместе с `render=iter`.
+    Возвращает количество записанных сообщений.
+    """
+    stream = sys.stdout if stream is None else stream
+    if isinstance(stream, int):
+        def write(text: str) -> None:
+            data = memoryview(text.encode('utf-8'))
+            while data:
+                data = data[os.write(stream, data):]
+    else:
+        write = stream.write
+    if INSTRUMENTATION is not None:
+        write = INSTRUMENTATION.wrap('output', write, label=_all)
+    if fmt in MESSAGE_HEADERS:
+        write(MESSAGE_HEADERS[fmt])
+    messages = iter(messages)
+    count = 0
+    while True:
+        chunk = list(itertools.islice(messages, chunk_size))
+        if not chunk:
+            return count
+        write(render_messages(chunk, fmt))
+        count += len(chunk)
+
+
+class Instrumentation:
+    """Счётчики и гистограммы времени по стадиям и видам тренировок.
+
+    Стадии конвейера обращаются к `INSTRUMENTATION` один раз на вызов
+    стадии, а не на пакет, поэтому выключенный сбор ничего не стоит.
+    Вид тренировки во всех стадиях помечается именем класса, как
+    в `InfoMessage.training_type`.
+    """
+    BUCKETS: tuple = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+    def __init__(self) -> None:
+        self.items: dict = {}
+        self.histograms: dict = {}
+
+    def observe(self, stage: str, label: str, seconds: float,
+                items: int = 1) -> None:
+        """Учесть один вызов стадии, обработавший `items` элементов."""
+        key = (stage, label)
+        self.items[key] = self.items.get(key, 0) + items
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * len(self.BUCKETS) + [
+                0, 0.0
+            ]
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+    def wrap(self, stage: str, func: Callable,
+             label: Callable = str) -> Callable:
+        """Обернуть функцию замером времени каждого вызова.
+
+        Метка вида тренировки берётся из первого аргумента вызова.
+        """
+        perf_counter = time.perf_counter
+
+        def timed(item, *args):
+            start = perf_counter()
+            result = func(item, *args)
+            self.observe(stage, label(item), perf_counter() - start)
+            return result
+        return timed
+
+    def to_prometheus(self) -> str:
+        """Снимок в текстовом формате Prometheus."""
+        lines = ['# TYPE fitness_stage_items_total counter']
+        for (stage, label), items in sorted(self.items.items()):
+            lines.append(f'fitness_stage_items_total{{stage="{stage}",'
+                         f'workout="{label}"}} {items}')
+        lines.append('# TYPE fitness_stage_seconds histogram')
+        for (stage, label), histogram in sorted(self.histograms.items()):
+            labels = f'stage="{stage}",workout="{label}"'
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram):
+                lines.append(f'fitness_stage_seconds_bucket{{{labels},'
+                             f'le="{bound}"}} {count}')
+            lines.append(f'fitness_stage_seconds_sum{{{labels}}} '
+                         f'{histogram[-1]!r}')
+            lines.append(f'fitness_stage_seconds_count{{{labels}}} '
+                         f'{histogram[-2]}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> str:
+        """Снимок в формате JSON."""
+        return json.dumps([
+            {'stage': stage, 'workout': label,
+             'items': self.items[stage, label],
+             'count': histogram[-2], 'sum': histogram[-1],
+             'buckets': dict(zip(map(str, self.BUCKETS), histogram))}
+            for (stage, label), histogram in sorted(self.histograms.items())
+        ], ensure_ascii=False, indent=2)
+
+    def dump(self, path: str) -> None:
+        """Записать снимок в файл: JSON для `.json`, иначе Prometheus."""
+        text = (self.to_json() if path.endswith('.json')
+                else self.to_prometheus())
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write(text)
+
+
+INSTRUMENTATION: Optional[Instrumentation] = None
+
+
+def enable_instrumentation() -> Instrumentation:
+    """Включить сбор метрик и вернуть новый сборщик."""
+    global INSTRUMENTATION
+    INSTRUMENTATION = Instrumentation()
+    return INSTRUMENTATION
+
+
+def disable_instrumentation() -> None:
+    """Выключить сбор метрик."""
+    global INSTRUMENTATION
+    INSTRUMENTATION = None
+
+
+def _all(item) -> str:
+    return 'all'
+
+
+def _class_name(item) -> str:
+    return item.__class__.__name__
+
+
+def _workout_name(workout_type) -> str:
+    training = WORKOUT_TYPES.get(workout_type)
+    return str(workout_type) if training is None else training.__name__
+
+
+def _training_type(message: InfoMessage) -> str:
+    return message.training_type
+
+
+_MISSING = object()
+_ARGUMENTS = object()
+
+
+def cached_metric(method: Callable) -> Callable:
+    """Кэшировать показатель тренировки до изменения её параметров.
+
+    Вместе с показателями запоминаются значения `FIELDS`: если они
+    изменились, кэш сбрасывается при следующем чтении. Так присваивание
+    полей, в том числе в `__init__`, не стоит ничего лишнего.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        metrics = self._metrics
+        if metrics is not None:
+            value = metrics.get(name, _MISSING)
+            if (value is not _MISSING
+                    and metrics[_ARGUMENTS] == self.KERNEL_ARGUMENTS(self)):
+                return value
+        value = method(self)
+        metrics = self._metrics
+        arguments = self.KERNEL_ARGUMENTS(self)
+        if metrics is None or metrics[_ARGUMENTS] != arguments:
+            metrics = self._metrics = {_ARGUMENTS: arguments}
+        metrics[name] = value
+        return value
+    return wrapper
+
+
+class UnknownWorkoutError(Exception):
+    """Пакет с незарегистрированным видом тренировки."""
+
+    def __init__(self, workout_type) -> None:
+        super().__init__(f'Нет такой тренировки: {workout_type!r}')
+        self.workout_type = workout_type
+
+
+class PackageLengthError(TypeError):
+    """Число параметров в пакете не совпадает с видом тренировки."""
+
+
+WORKOUT_TYPES: dict = {}
+WORKOUT_CODES: dict = {}
+WORKOUT_NAMES: dict = {}
+PACKET_STRUCTS: dict = {}
+SLOTTED_WORKOUT_TYPES: dict = {}
+
+
+def register_workout(workout_type: str, code: int) -> Callable:
+    """Зарегистрировать класс тренировки под кодом пакета.
+
+    Число параметров и формат бинарного пакета считаются один раз
+    при регистрации, а `read_package()` ищет класс одним обращением
+    к словарю. Там же создаётся компактный вариант класса для
+    `SLOTTED_WORKOUT_TYPES`, см. `make_slotted()`.
+    """
+    def register(cls: type) -> type:
+        if workout_type in WORKOUT_TYPES or code in WORKOUT_NAMES:
+            raise ValueError(f'Тренировка {workout_type!r} или код {code} '
+                             'уже зарегистрированы')
+        cls.ARGUMENTS = len(cls.FIELDS)
+        WORKOUT_TYPES[workout_type] = cls
+        WORKOUT_CODES[workout_type] = code
+        WORKOUT_NAMES[code] = workout_type
+        PACKET_STRUCTS[code] = struct.Struct('<B' + 'd' * cls.ARGUMENTS)
+        SLOTTED_WORKOUT_TYPES[workout_type] = make_slotted(cls,
+                                                           SlottedTraining)
+        return cls
+    return register
+
+
+class _InlineConstants(ast.NodeTransformer):
+    """Заменить имена констант класса их значениями."""
+
+    def __init__(self, constants: dict) -> None:
+        self.constants = constants
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id in self.constants:
+            return ast.copy_location(ast.Constant(self.constants[node.id]),
+                                     node)
+        return node
+
+
+def class_constants(cls: type) -> dict:
+    """Числовые константы класса: имена в верхнем регистре."""
+    return {name: getattr(cls, name) for name in dir(cls)
+            if name.isupper()
+            and isinstance(getattr(cls, name), (int, float))}
+
+
+def _formula_names(formula: str) -> set:
+    return {node.id for node in ast.walk(ast.parse(formula, mode='eval'))
+            if isinstance(node, ast.Name)}
+
+
+def _compile_function(cls: type, source: str, name: str) -> Callable:
+    tree = _InlineConstants(class_constants(cls)).visit(ast.parse(source))
+    namespace: dict = {}
+    exec(compile(ast.fix_missing_locations(tree),
+                 f'<{name} {cls.__qualname__}>', 'exec'), namespace)
+    function = namespace['kernel']
+    function.__qualname__ = f'{cls.__qualname__}.{name}'
+    return function
+
+
+def _metric_formulas(cls: type, metrics: tuple) -> dict:
+    """Формулы `metrics` и показателей, от которых они зависят."""
+    needed = set(metrics)
+    for metric in reversed(list(cls.FORMULAS)):
+        if metric in needed:
+            needed |= _formula_names(cls.FORMULAS[metric]) & set(cls.FORMULAS)
+    return {metric: formula for metric, formula in cls.FORMULAS.items()
+            if metric in needed}
+
+
+def compile_kernel(cls: type,
+                   metrics: tuple = ('distance', 'speed', 'calories'),
+                   name: str = 'KERNEL') -> Callable:
+    """Собрать плоскую функцию показателей по `FORMULAS` класса.
+
+    Функция принимает параметры из `cls.FIELDS` и возвращает показатели
+    `metrics`, один показатель без кортежа. Считаются только формулы,
+    от которых они зависят. Константы класса подставляются в код числами.
+    """
+    source = (f'def kernel({", ".join(cls.FIELDS)}):\n'
+              + ''.join(f'    {metric} = {formula}\n' for metric, formula
+                        in _metric_formulas(cls, metrics).items())
+              + f'    return {", ".join(metrics)}\n')
+    return _compile_function(cls, source, name)
+
+
+def compile_batch_kernel(cls: type,
+                         metrics: tuple = ('distance', 'speed', 'calories'),
+                         name: str = 'BATCH_KERNEL') -> Callable:
+    """Собрать проход по строкам батча по тем же `FORMULAS`.
+
+    Функция `(columns, index)` возвращает по списку на каждый показатель
+    из `metrics` и читает только колонки, которые нужны их формулам.
+    Выражения те же, что в `compile_kernel()`, поэтому результаты
+    совпадают до бита.
+    """
+    formulas = _metric_formulas(cls, metrics)
+    names = set().union(*map(_formula_names, formulas.values()))
+    fields = [field for field in cls.FIELDS if field in names]
+    lines = ['def kernel(columns, index):']
+    lines += [f'    _column_{field} = columns[{field!r}]' for field in fields]
+    lines += [f'    _result_{metric} = []' for metric in metrics]
+    lines += [f'    _append_{metric} = _result_{metric}.append'
+              for metric in metrics]
+    lines.append('    for _row in index:')
+    lines += [f'        {field} = _column_{field}[_row]' for field in fields]
+    lines += [f'        {metric} = {formula}'
+              for metric, formula in formulas.items()]
+    lines += [f'        _append_{metric}({metric})' for metric in metrics]
+    results = ', '.join(f'_result_{metric}' for metric in metrics)
+    lines.append(f'    return {results}')
+    return _compile_function(cls, '\n'.join(lines) + '\n', name)
+
+
+HEIGHT_REQUIRED: str = 'Для калорий ходьбы нужен рост пользователя'
+
+
+def _bad_values(column, index: list, positive: bool) -> list:
+    """Маска значений колонки вне допустимого диапазона или не чисел."""
+    try:
+        if positive:
+            return [not 0 < column[i] < math.inf for i in index]
+        return [not 0 <= column[i] < math.inf for i in index]
+    except TypeError:
+        return [not isinstance(column[i], (int, float))
+                or _bad_values(column, [i], positive)[0] for i in index]
 
 
 class Training:
@@ -28,6 +467,16 @@ class Training:
     CONST: int = 60
     METR_TO_SM: int = 100
     HOURINMIN: int = 60
+    FIELDS: tuple = ('action', 'duration', 'weight')
+    POSITIVE: tuple = ('duration',)
+    INFO_MESSAGE: type = InfoMessage
+    STATE: tuple = ('_metrics',)
+    _metrics: Optional[dict] = None
+    FORMULAS: dict = {
+        'distance': 'action * LEN_STEP / M_IN_KM',
+        'speed': 'distance / duration',
+        'calories': 'None',
+    }
 
     def __init__(self,
                  action: float,
@@ -38,42 +487,279 @@ class Training:
         self.duration: float = duration
         self.weight: float = weight
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.build_kernel()
+        cls.COEFFICIENTS = cls.fold_constants()
+
+    @classmethod
+    def build_kernel(cls) -> None:
+        """Собрать по `FORMULAS` скалярные и пакетные ядра класса.
+
+        Кроме общего `KERNEL` в `METRIC_KERNELS` лежит по ядру на каждый
+        показатель: оно считает только нужные ему формулы.
+        """
+        cls.KERNEL = staticmethod(compile_kernel(cls))
+        cls.METRIC_KERNELS = {
+            metric: compile_kernel(cls, (metric,),
+                                   f'METRIC_KERNELS[{metric!r}]')
+            for metric in ('distance', 'speed', 'calories')
+        }
+        cls.BATCH_KERNEL = staticmethod(compile_batch_kernel(cls))
+        cls.MOTION_KERNEL = staticmethod(compile_batch_kernel(
+            cls, ('distance', 'speed'), 'MOTION_KERNEL'
+        ))
+        cls.KERNEL_ARGUMENTS = operator.attrgetter(*cls.FIELDS)
+
+    @classmethod
+    def fold_constants(cls) -> Optional[dict]:
+        """Свернуть формулу калорий в коэффициенты при создании класса.
+
+        Калории приводятся к виду
+        `weight * duration * (speed * s + base + speed ** 2 / height * s2)`.
+        `FORMULAS['calories']` считается в точных дробях при скоростях
+        0, 1 и 2, откуда находятся `s`, `base` и `s2`, и проверяется
+        ещё в двух точках. Если формула не сводится к этому виду,
+        возвращается None.
+        """
+        constants = {name: Fraction(value)
+                     for name, value in class_constants(cls).items()}
+        code = compile(cls.FORMULAS['calories'], '<calories>', 'eval')
+
+        def calories(speed, weight=1, duration=1, height=1):
+            return eval(code, {'__builtins__': {}},
+                        {**constants, 'speed': Fraction(speed),
+                         'weight': Fraction(weight),
+                         'duration': Fraction(duration),
+                         'height': Fraction(height)})
+        try:
+            base = calories(0)
+            speed2_k = (calories(2) - 2 * calories(1) + base) / 2
+            speed_k = calories(1) - base - speed2_k
+            for point in ((7, 2, 3, 5), (Fraction(1, 3), 70, 1.5, 170)):
+                speed, weight, duration, height = map(Fraction, point)
+                folded = weight * duration * (speed * speed_k + base
+                                              + speed ** 2 / height * speed2_k)
+                if calories(speed, weight, duration, height) != folded:
+                    return None
+        except (ArithmeticError, NameError, TypeError):
+            return None
+        return {'speed': float(speed_k),
+                'base': float(base),
+                'speed2_height': float(speed2_k)}
+
+    def invalidate(self) -> None:
+        """Сбросить кэш показателей, например после изменения не полей."""
+        self._metrics = None
+
+    def get_metrics(self) -> tuple:
+        """Получить дистанцию, скорость и калории одним вызовом `KERNEL`.
+
+        Формулы зависят друг от друга (скорость от дистанции, калории от
+        скорости), поэтому ядро всегда считает все три показателя, и все
+        три сразу попадают в кэш: любой геттер или `show_training_info()`
+        вызывает формулы ровно один раз.
+        """
+        arguments = self.KERNEL_ARGUMENTS(self)
+        metrics = self.KERNEL(*arguments)
+        self._metrics = {_ARGUMENTS: arguments,
+                         'get_distance': metrics[0],
+                         'get_mean_speed': metrics[1],
+                         'get_spent_calories': metrics[2]}
+        return metrics
+
+    @cached_metric
     def get_distance(self) -> float:
         """Получить дистанцию в км."""
-        return self.action * self.LEN_STEP / self.M_IN_KM
+        return self.get_metrics()[0]
 
+    @cached_metric
     def get_mean_speed(self) -> float:
         """Получить среднюю скорость движения."""
-        return self.get_distance() / self.duration
+        return self.get_metrics()[1]
 
+    @cached_metric
     def get_spent_calories(self) -> float:
         """Получить количество затраченных калорий."""
-        pass
+        return self.get_metrics()[2]
 
-    def show_training_info(self) -> InfoMessage:
-        """Вернуть информационное сообщение о выполненной тренировке."""
-        return InfoMessage(self.__class__.__name__,
-                           self.duration, self.get_distance(),
-                           self.get_mean_speed(), self.get_spent_calories()
-                           )
+    def show_training_info(self, lazy: bool = False) -> InfoMessage:
+        """Вернуть информационное сообщение о выполненной тренировке.
 
+        С `lazy=True` возвращается `LazyInfoMessage`, поля которого
+        считаются при первом чтении.
+        """
+        if lazy:
+            return LazyInfoMessage(self)
+        return self.INFO_MESSAGE(self.__class__.__name__,
+                                 self.duration, self.get_distance(),
+                                 self.get_mean_speed(),
+                                 self.get_spent_calories()
+                                 )
 
+    @classmethod
+    def get_batch_errors(cls, columns: dict, index: list) -> dict:
+        """Найти строки батча с недопустимыми параметрами.
+
+        Каждый параметр проверяется маской по всем строкам сразу: делители
+        из `POSITIVE` должны быть больше нуля, остальные не меньше нуля,
+        NaN, бесконечность и не числа не допускаются. Возвращает причину
+        отказа для каждой плохой строки.
+        """
+        errors: dict = {}
+        for name in cls.FIELDS:
+            column = columns[name]
+            positive = name in cls.POSITIVE
+            rule = 'больше нуля' if positive else 'не меньше нуля'
+            for i, bad in zip(index, _bad_values(column, index, positive)):
+                if bad and i not in errors:
+                    errors[i] = f'{name} должно быть {rule}: {column[i]!r}'
+        return errors
+
+    @classmethod
+    def get_batch_metrics(cls, columns: dict, index: list) -> tuple:
+        """Дистанции, скорости и калории строк батча по `FORMULAS`."""
+        return cls.BATCH_KERNEL(columns, index)
+
+    @classmethod
+    def get_batch_motion(cls, columns: dict, index: list) -> tuple:
+        """Дистанции и скорости строк батча, без веса и роста."""
+        return cls.MOTION_KERNEL(columns, index)
+
+    @classmethod
+    def get_batch_folded(cls, columns: dict, index: list) -> tuple:
+        """Дистанции, скорости и калории по свёрнутым коэффициентам.
+
+        Дистанции и скорости точные, калории отличаются от
+        `get_batch_metrics()` только порядком округлений, относительная
+        погрешность порядка 1e-15. Если формула калорий не сворачивается,
+        батч считается по точным формулам.
+        """
+        if cls.COEFFICIENTS is None:
+            return cls.get_batch_metrics(columns, index)
+        distances, speeds = cls.get_batch_motion(columns, index)
+        weight = columns['weight']
+        duration = columns['duration']
+        speed_k = cls.COEFFICIENTS['speed']
+        base_k = cls.COEFFICIENTS['base']
+        speed2_k = cls.COEFFICIENTS['speed2_height']
+        if not speed2_k:
+            return distances, speeds, [
+                weight[i] * duration[i] * (speed_k * speed + base_k)
+                for speed, i in zip(speeds, index)
+            ]
+        height = columns['height']
+        return distances, speeds, [
+            weight[i] * duration[i]
+            * (speed_k * speed + base_k + speed * speed / height[i] * speed2_k)
+            for speed, i in zip(speeds, index)
+        ]
+
+    @classmethod
+    def get_coefficients(cls) -> tuple:
+        """Свёрнутые `(s, base, s2)` или TypeError, если их нет."""
+        if cls.COEFFICIENTS is None:
+            raise TypeError(f'Калории {cls.__name__} не сворачиваются '
+                            'в коэффициенты')
+        return (cls.COEFFICIENTS['speed'], cls.COEFFICIENTS['base'],
+                cls.COEFFICIENTS['speed2_height'])
+
+    @classmethod
+    def get_user_coefficients(cls, weight: float,
+                              height: Optional[float] = None) -> tuple:
+        """Коэффициенты калорий, заранее умноженные на вес и рост.
+
+        Для истории одного пользователя калории тренировки равны
+        `duration * (speed * a + b + speed ** 2 * c)`. Если калории
+        зависят от роста, а он не задан, выбрасывается ValueError.
+        """
+        speed_k, base_k, speed2_k = cls.get_coefficients()
+        if speed2_k and not height:
+            raise ValueError(HEIGHT_REQUIRED)
+        return (speed_k * weight, base_k * weight,
+                speed2_k * weight / height if speed2_k else 0.0)
+
+
+Training.build_kernel()
+
+
+def _init_slots(self, *args) -> None:
+    if len(args) != len(self.FIELDS):
+        raise TypeError(f'{self.__class__.__name__} ожидает '
+                        f'{len(self.FIELDS)} аргументов, '
+                        f'получено {len(args)}')
+    for name in getattr(self, 'STATE', ()):
+        object.__setattr__(self, name, None)
+    for name, value in zip(self.FIELDS, args):
+        setattr(self, name, value)
+
+
+def make_slotted(cls: type, base: type = object, **attrs) -> type:
+    """Создать вариант класса с `__slots__` вместо `__dict__`.
+
+    Методы и константы копируются из `cls` и его предков, которых нет
+    у исходного класса `base`, поля берутся из `cls.FIELDS`, служебные
+    словари экземпляра (кэш показателей) из `cls.STATE`, они создаются
+    равными None. Имя класса сохраняется, чтобы `show_training_info()`
+    выдавал тот же тип тренировки.
+
+    Вариант не наследует `cls`: у любого наследника класса с `__dict__`
+    был бы и `__dict__`. Поэтому `isinstance(SlottedRunning(...),
+    Training)` ложно, а подходит вариант везде, где нужен только
+    интерфейс тренировки, например в `main()`. Исходный класс лежит
+    в атрибуте `SLOTTED_FROM`.
+    """
+    skip = getattr(base, 'SLOTTED_FROM', object).__mro__
+    namespace: dict = {}
+    for ancestor in reversed(cls.__mro__):
+        if ancestor not in skip:
+            namespace.update(vars(ancestor))
+    for name in ('__dict__', '__weakref__', '__init__', '__init_subclass__',
+                 *getattr(cls, 'STATE', ())):
+        namespace.pop(name, None)
+    inherited = getattr(base, 'STATE', ()) + getattr(base, 'FIELDS', ())
+    namespace.update(attrs)
+    namespace['__slots__'] = tuple(
+        name for name in getattr(cls, 'STATE', ()) + cls.FIELDS
+        if name not in inherited
+    )
+    namespace['__init__'] = _init_slots
+    namespace['__qualname__'] = 'Slotted' + cls.__name__
+    namespace['SLOTTED_FROM'] = cls
+    return type(cls.__name__, (base,), namespace)
+
+
+SlottedInfoMessage = make_slotted(InfoMessage)
+SlottedTraining = make_slotted(Training, INFO_MESSAGE=SlottedInfoMessage)
+
+
+@register_workout('RUN', 2)
 class Running(Training):
     """Тренировка: бег."""
     CMF: int = 18
     CMS: float = 1.79
-
-    def get_spent_calories(self) -> float:
-        return ((self.CMF * self.get_mean_speed() + self.CMS)
-                * self.weight / self.M_IN_KM * self.duration * self.HOURINMIN)
+    FORMULAS: dict = {
+        **Training.FORMULAS,
+        'calories': ('(CMF * speed + CMS)'
+                     ' * weight / M_IN_KM * duration * HOURINMIN'),
+    }
 
 
+@register_workout('WLK', 3)
 class SportsWalking(Training):
     """Тренировка: спортивная ходьба."""
     CMF: float = 0.035
     CMS: float = 0.029
     METRPS: float = 0.278
     METR_TO_SM: int = 100
+    FIELDS: tuple = Training.FIELDS + ('height',)
+    POSITIVE: tuple = Training.POSITIVE + ('height',)
+    FORMULAS: dict = {
+        **Training.FORMULAS,
+        'calories': ('(CMF * weight'
+                     ' + (speed * METRPS) ** 2 / (height / METR_TO_SM)'
+                     ' * CMS * weight) * duration * HOURINMIN'),
+    }
 
     def __init__(self,
                  action: float,
@@ -84,18 +770,19 @@ class SportsWalking(Training):
         super().__init__(action, duration, weight)
         self.height: float = height
 
-    def get_spent_calories(self) -> float:
-        avgspeed: float = (self.get_mean_speed() * self.METRPS) ** 2
-        return ((self.CMF * self.weight
-                 + (avgspeed / (self.height / self.METR_TO_SM))
-                 * self.CMS * self.weight) * self.duration * self.HOURINMIN)
-
 
+@register_workout('SWM', 1)
 class Swimming(Training):
     """Тренировка: плавание."""
     CMF: float = 1.1
     MULTITWO: int = 2
     LEN_STEP: float = 1.38
+    FIELDS: tuple = Training.FIELDS + ('length_pool', 'count_pool')
+    FORMULAS: dict = {
+        **Training.FORMULAS,
+        'speed': 'length_pool * count_pool / M_IN_KM / duration',
+        'calories': '(speed + CMF) * MULTITWO * weight * duration',
+    }
 
     def __init__(self,
                  action: float,
@@ -108,40 +795,1710 @@ class Swimming(Training):
         self.length_pool: float = length_pool
         self.count_pool: int = count_pool
 
+
+EARTH_RADIUS_KM: float = 6371.0
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Расстояние по большому кругу между точками в градусах, км."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return (2 * EARTH_RADIUS_KM
+            * math.asin(min(1.0, math.sqrt(a))))
+
+
+class TrackTraining(Training):
+    """Тренировка по посекундным отсчётам GPS и пульса.
+
+    Отсчёты подаются кусками через `feed()` и обрабатываются за один
+    проход: хранится только последняя точка и накопленные суммы, поэтому
+    память не зависит от длины трека. Калории считаются по пульсу
+    формулой Keytel и др. (2005) для мужчин. Формула линейна по пульсу,
+    поэтому копятся только минуты с пульсом и сумма пульса по минутам,
+    а вес и возраст подставляются при чтении: их можно менять и после
+    подачи отсчётов. Отрицательный расход обнуляется для трека
+    целиком. Формул `FORMULAS` у трека
+    нет, поэтому нет и ядер, свёрнутых коэффициентов и пакетного расчёта.
+    """
+    SEC_IN_HOUR: int = 3600
+    SEC_IN_MIN: int = 60
+    HR_SHIFT: float = -55.0969
+    HR_MULTIPLIER: float = 0.6309
+    HR_WEIGHT_MULTIPLIER: float = 0.1988
+    HR_AGE_MULTIPLIER: float = 0.2017
+    KJ_IN_KCAL: float = 4.184
+    FIELDS: tuple = ('weight', 'age')
+    POSITIVE: tuple = ()
+    FORMULAS: dict = {}
+
+    @classmethod
+    def build_kernel(cls) -> None:
+        cls.KERNEL = cls.BATCH_KERNEL = cls.MOTION_KERNEL = None
+        cls.METRIC_KERNELS = None
+        cls.KERNEL_ARGUMENTS = operator.attrgetter(*cls.FIELDS)
+
+    @classmethod
+    def fold_constants(cls) -> None:
+        return None
+
+    @classmethod
+    def get_batch_metrics(cls, columns: dict, index: list) -> tuple:
+        raise TypeError(f'{cls.__name__} считается по отсчётам, '
+                        f'а не по колонкам батча')
+
+    get_batch_motion = get_batch_folded = get_batch_metrics
+
+    def __init__(self, weight: float, age: float) -> None:
+        super().__init__(0, 0.0, weight)
+        self.age: float = age
+        self.kilometers: float = 0.0
+        self.heart_minutes: float = 0.0
+        self.heart_beats: float = 0.0
+        self._start: Optional[float] = None
+        self._last: Optional[tuple] = None
+
+    def feed(self, timestamps: Iterable[float], latitudes: Iterable[float],
+             longitudes: Iterable[float],
+             heart_rates: Optional[Iterable[float]] = None) -> None:
+        """Учесть очередной кусок отсчётов (секунды, градусы, уд/мин)."""
+        if heart_rates is None:
+            heart_rates = itertools.repeat(None)
+        last = self._last
+        for sample in zip(timestamps, latitudes, longitudes, heart_rates):
+            timestamp, latitude, longitude, heart_rate = sample
+            if last is None:
+                self._start = timestamp
+            else:
+                self.kilometers += haversine(last[1], last[2],
+                                             latitude, longitude)
+                if heart_rate:
+                    minutes = (timestamp - last[0]) / self.SEC_IN_MIN
+                    self.heart_minutes += minutes
+                    self.heart_beats += heart_rate * minutes
+            last = sample
+        if last is not None:
+            self._last = last
+            self.duration = (last[0] - self._start) / self.SEC_IN_HOUR
+        self.invalidate()
+
+    def get_metrics(self) -> tuple:
+        return (self.get_distance(), self.get_mean_speed(),
+                self.get_spent_calories())
+
+    @cached_metric
+    def get_distance(self) -> float:
+        return self.kilometers
+
+    @cached_metric
     def get_mean_speed(self) -> float:
-        return (self.length_pool * self.count_pool
-                / self.M_IN_KM / self.duration)
+        return self.get_distance() / self.duration if self.duration else 0.0
 
+    @cached_metric
     def get_spent_calories(self) -> float:
-        return ((self.get_mean_speed() + self.CMF)
-                * self.MULTITWO * self.weight * self.duration)
+        per_minute = (self.HR_SHIFT
+                      + self.HR_WEIGHT_MULTIPLIER * self.weight
+                      + self.HR_AGE_MULTIPLIER * self.age)
+        return max(0.0, per_minute * self.heart_minutes
+                   + self.HR_MULTIPLIER * self.heart_beats) / self.KJ_IN_KCAL
+
+
+class TrackRunning(TrackTraining):
+    """Тренировка по трекеру: бег."""
+
+
+class TrackWalking(TrackTraining):
+    """Тренировка по трекеру: ходьба."""
+
+
+SlottedRunning = SLOTTED_WORKOUT_TYPES['RUN']
+SlottedSportsWalking = SLOTTED_WORKOUT_TYPES['WLK']
+SlottedSwimming = SLOTTED_WORKOUT_TYPES['SWM']
+
+
+def check_package(workout_type: str, data: list,
+                  types: dict = WORKOUT_TYPES) -> type:
+    """Вернуть класс тренировки для пакета или выбросить ошибку пакета."""
+    try:
+        training = types[workout_type]
+    except (KeyError, TypeError):
+        raise UnknownWorkoutError(workout_type) from None
+    if len(data) != training.ARGUMENTS:
+        raise PackageLengthError(f'{training.__name__} ожидает '
+                                 f'{training.ARGUMENTS} параметров, '
+                                 f'получено {len(data)}')
+    return training
 
 
-def read_package(workout_type: str, data: list) -> Training:
+def read_package(workout_type: str, data: list,
+                 types: dict = WORKOUT_TYPES) -> Training:
     """Прочитать данные полученные от датчиков."""
-    types = {
-        'SWM': Swimming,
-        'RUN': Running,
-        'WLK': SportsWalking
-    }
-    if not (workout_type in types.keys()):
-        raise Exception("Нет такой тренировки")
-    return types[workout_type](*data)
+    return check_package(workout_type, data, types)(*data)
+
+
+def read_packages_columns(packages) -> tuple:
+    """Разложить пакеты датчиков по колонкам для `process_batch()`."""
+    workout_types: list = []
+    columns: dict = {}
+    for workout_type, data in packages:
+        training = check_package(workout_type, data)
+        row = len(workout_types)
+        workout_types.append(workout_type)
+        for name, value in zip(training.FIELDS, data):
+            column = columns.setdefault(name, [])
+            column.extend([0] * (row - len(column)))
+            column.append(value)
+    for column in columns.values():
+        column.extend([0] * (len(workout_types) - len(column)))
+    return workout_types, columns
+
+
+RESULT_FIELDS: tuple = ('duration', 'distance', 'speed', 'calories')
+PRECISIONS: dict = {'double': 'd', 'single': 'f'}
+SINGLE_PRECISION_ERROR: float = 1e-6
+
+
+def _group_rows(workout_types: list) -> dict:
+    groups: dict = {}
+    for i, workout_type in enumerate(workout_types):
+        groups.setdefault(workout_type, []).append(i)
+    return groups
+
+
+def _split_rows(workout_type: str, columns: dict, index: list) -> tuple:
+    if workout_type not in WORKOUT_TYPES:
+        reason = str(UnknownWorkoutError(workout_type))
+        return [], {i: reason for i in index}
+    errors = WORKOUT_TYPES[workout_type].get_batch_errors(columns, index)
+    return [i for i in index if i not in errors], errors
+
+
+def validate_batch(workout_types: list, columns: dict) -> tuple:
+    """Разделить батч на чистые строки и отказы.
+
+    Возвращает отсортированный список чистых строк и список
+    `(row, workout_type, reason)` для отказов.
+    """
+    clean: list = []
+    rejects: list = []
+    for workout_type, index in _group_rows(workout_types).items():
+        good, errors = _split_rows(workout_type, columns, index)
+        clean.extend(good)
+        rejects.extend((i, workout_type, reason)
+                       for i, reason in errors.items())
+    return sorted(clean), sorted(rejects)
+
+
+def process_batch(workout_types: list, columns: dict,
+                  dead_letter: Optional[list] = None,
+                  exact: bool = True, precision: str = 'double') -> dict:
+    """Посчитать показатели для батча тренировок по колонкам.
+
+    `columns` сопоставляет имя параметра тренировки (`action`, `duration`,
+    `weight`, `height`, `length_pool`, `count_pool`) с последовательностью
+    значений, выровненной по `workout_types`. Каждый вид тренировки
+    считается одним проходом по своим строкам, результат численно совпадает
+    с методами `show_training_info()`.
+
+    Если передан список `dead_letter`, батч сначала проверяется масками
+    `get_batch_errors()`: плохие строки дописываются в него как
+    `(row, workout_type, reason)` и получают NaN во всех показателях,
+    остальные считаются как обычно.
+
+    С `exact=False` калории считаются по свёрнутым коэффициентам
+    `get_batch_folded()`, быстрее, но не бит в бит с методами.
+
+    С `precision='single'` результат хранится в `array('f')`: вдвое
+    меньше памяти, а абсолютная погрешность показателя не больше
+    `value * SINGLE_PRECISION_ERROR` (1e-6) даже для колонок
+    `TrainingBatch` в float32. При выводе с тремя знаками последний знак
+    может отличаться на единицу при любой величине значения: достаточно,
+    чтобы оно лежало рядом с границей округления `.xxx5`.
+    """
+    size = len(workout_types)
+    typecode = PRECISIONS[precision]
+    empty = bytes(array(typecode).itemsize * size)
+    result = {name: array(typecode, empty) for name in RESULT_FIELDS}
+    for workout_type, index in _group_rows(workout_types).items():
+        if dead_letter is not None:
+            index, errors = _split_rows(workout_type, columns, index)
+            for i, reason in errors.items():
+                dead_letter.append((i, workout_type, reason))
+                for column in result.values():
+                    column[i] = math.nan
+            if not index:
+                continue
+        elif workout_type not in WORKOUT_TYPES:
+            raise UnknownWorkoutError(workout_type)
+        training = WORKOUT_TYPES[workout_type]
+        compute = (training.get_batch_metrics if exact
+                   else training.get_batch_folded)
+        start = time.perf_counter()
+        distances, speeds, calories = compute(columns, index)
+        if INSTRUMENTATION is not None:
+            INSTRUMENTATION.observe('compute', training.__name__,
+                                    time.perf_counter() - start, len(index))
+        duration = columns['duration']
+        for i, distance, speed, spent in zip(index, distances,
+                                             speeds, calories):
+            result['duration'][i] = duration[i]
+            result['distance'][i] = distance
+            result['speed'][i] = speed
+            result['calories'][i] = spent
+    return result
+
+
+def process_user_history(workout_type: str, columns: dict, weight: float,
+                         height: Optional[float] = None) -> dict:
+    """Посчитать все тренировки одного вида для одного пользователя.
+
+    Вес и рост пользователя общие для всей истории, поэтому зависящие
+    от них множители считаются один раз через `get_user_coefficients()`.
+    Колонки `weight` и `height` не нужны.
+    """
+    if workout_type not in WORKOUT_TYPES:
+        raise UnknownWorkoutError(workout_type)
+    training = WORKOUT_TYPES[workout_type]
+    index = range(len(columns['duration']))
+    distances, speeds = training.get_batch_motion(columns, index)
+    speed_k, base_k, speed2_k = training.get_user_coefficients(weight, height)
+    duration = columns['duration']
+    calories = [duration[i] * (speed * speed_k + base_k
+                               + speed * speed * speed2_k)
+                for speed, i in zip(speeds, index)]
+    return {'duration': array('d', duration),
+            'distance': array('d', distances),
+            'speed': array('d', speeds),
+            'calories': array('d', calories)}
+
+
+class UserHistory:
+    """История тренировок одного пользователя с пересчётом калорий.
+
+    Калории любой тренировки равны `weight * (linear + quadratic / height)`,
+    где `linear` и `quadratic` зависят только от параметров тренировки
+    и `COEFFICIENTS` класса. Они хранятся по строкам, поэтому после
+    исправления веса или роста калории всей истории пересчитываются
+    одним проходом по двум колонкам, без `read_package()`. Точность та же,
+    что у `process_batch(exact=False)`.
+    """
+    COLUMNS: tuple = ('duration', 'distance', 'speed', 'linear',
+                      'quadratic', 'calories')
+
+    def __init__(self, weight: float, height: Optional[float] = None) -> None:
+        self.weight: float = weight
+        self.height: Optional[float] = height
+        self.workout_types: list = []
+        self.columns: dict = {name: array('d') for name in self.COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self.workout_types)
+
+    def __getitem__(self, name: str) -> array:
+        return self.columns[name]
+
+    def extend(self, workout_types: list, columns: dict) -> None:
+        """Дописать тренировки по колонкам параметров.
+
+        Колонки как у `process_batch()`, но `weight` и `height`
+        берутся из профиля пользователя.
+        """
+        size = len(workout_types)
+        rows = {name: array('d', bytes(8 * size)) for name in self.COLUMNS}
+        for workout_type, index in _group_rows(workout_types).items():
+            if workout_type not in WORKOUT_TYPES:
+                raise UnknownWorkoutError(workout_type)
+            training = WORKOUT_TYPES[workout_type]
+            distances, speeds = training.get_batch_motion(columns, index)
+            speed_k, base_k, speed2_k = training.get_coefficients()
+            duration = columns['duration']
+            for i, distance, speed in zip(index, distances, speeds):
+                rows['duration'][i] = duration[i]
+                rows['distance'][i] = distance
+                rows['speed'][i] = speed
+                rows['linear'][i] = duration[i] * (speed_k * speed + base_k)
+                rows['quadratic'][i] = duration[i] * speed * speed * speed2_k
+        rows['calories'] = self._rescale(rows['linear'], rows['quadratic'],
+                                         self.weight, self.height)
+        self.workout_types.extend(workout_types)
+        for name, column in self.columns.items():
+            column.extend(rows[name])
+
+    def update_profile(self, weight: Optional[float] = None,
+                       height: Optional[float] = None) -> array:
+        """Сменить вес и/или рост и пересчитать калории всей истории.
+
+        Если пересчёт невозможен, профиль и калории не меняются.
+        """
+        weight = self.weight if weight is None else weight
+        height = self.height if height is None else height
+        calories = self._rescale(self.columns['linear'],
+                                 self.columns['quadratic'], weight, height)
+        self.weight, self.height = weight, height
+        self.columns['calories'] = calories
+        return calories
+
+    @staticmethod
+    def _rescale(linear: array, quadratic: array, weight: float,
+                 height: Optional[float]) -> array:
+        if not height and any(quadratic):
+            raise ValueError(HEIGHT_REQUIRED)
+        scale = weight / height if height else 0.0
+        return array('d', [weight * term + scale * term2
+                           for term, term2 in zip(linear, quadratic)])
+
+
+def process_packages(packages: list, errors: str = 'strict') -> list:
+    """Посчитать список пакетов через `process_batch()`.
+
+    Возвращает по результату на пакет: `InfoMessage` или, если
+    `errors` не `'strict'`, кортеж отказа `(workout_type, data, reason)`
+    для неизвестных, неполных и недопустимых пакетов. В режиме
+    `'strict'` первая ошибка пакета выбрасывается. Отказы разбора
+    из `parse_packages()` и `parse_csv_packages()` проходят как есть.
+    """
+    results: list = [None] * len(packages)
+    accepted: list = []
+    for i, package in enumerate(packages):
+        if len(package) == 3:
+            results[i] = package
+            continue
+        workout_type, data = package
+        try:
+            check_package(workout_type, data)
+        except (UnknownWorkoutError, PackageLengthError) as error:
+            if errors == 'strict':
+                raise
+            results[i] = (workout_type, data, str(error))
+            continue
+        accepted.append(i)
+    workout_types, columns = read_packages_columns(
+        [packages[i] for i in accepted]
+    )
+    dead_letter = None if errors == 'strict' else []
+    batch = process_batch(workout_types, columns, dead_letter)
+    rejected = {row: reason for row, _, reason in dead_letter or ()}
+    for row, i in enumerate(accepted):
+        workout_type, data = packages[i]
+        if row in rejected:
+            results[i] = (workout_type, data, rejected[row])
+            continue
+        results[i] = InfoMessage(WORKOUT_TYPES[workout_type].__name__,
+                                 *(batch[name][row] for name in RESULT_FIELDS))
+    return results
+
+
+class TrainingBatch:
+    """Тренировки в виде колонок непрерывных массивов.
+
+    Вместо объекта на каждую тренировку хранится код вида тренировки
+    в `array('B')` и по одному `array('d')` на каждый параметр,
+    с `precision='single'` — `array('f')`, вдвое меньше памяти.
+    Параметры, которых нет у вида тренировки, заполняются нулями.
+    """
+    __slots__ = ('codes', 'columns', 'precision')
+
+    def __init__(self, precision: str = 'double') -> None:
+        names = dict.fromkeys(name for training in WORKOUT_TYPES.values()
+                              for name in training.FIELDS)
+        self.precision: str = precision
+        self.codes: array = array('B')
+        self.columns: dict = {name: array(PRECISIONS[precision])
+                              for name in names}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def append(self, workout_type: str, data: list) -> None:
+        """Добавить пакет датчиков в конец батча."""
+        training = check_package(workout_type, data)
+        values = dict(zip(training.FIELDS, data))
+        self.codes.append(WORKOUT_CODES[workout_type])
+        for name, column in self.columns.items():
+            column.append(values.get(name, 0.0))
+
+    @classmethod
+    def from_packages(cls, packages: Iterable[tuple],
+                      precision: str = 'double') -> 'TrainingBatch':
+        """Собрать батч из пар `(workout_type, data)`."""
+        batch = cls(precision)
+        for workout_type, data in packages:
+            batch.append(workout_type, data)
+        return batch
+
+    @property
+    def workout_types(self) -> list:
+        """Коды видов тренировок по строкам батча."""
+        return [WORKOUT_NAMES[code] for code in self.codes]
+
+    def compute(self) -> dict:
+        """Посчитать показатели всех тренировок батча."""
+        return process_batch(self.workout_types, self.columns,
+                             precision=self.precision)
+
+
+PACKET_HEADER = struct.Struct('<B')
+
+
+def encode_package(workout_type: str, data: list) -> bytes:
+    """Упаковать пакет датчиков: код тренировки и параметры в float64."""
+    check_package(workout_type, data)
+    code = WORKOUT_CODES[workout_type]
+    return PACKET_STRUCTS[code].pack(code, *data)
+
+
+def encode_packages(packages: Iterable[tuple]) -> bytes:
+    """Упаковать последовательность пакетов в один буфер."""
+    return b''.join(encode_package(workout_type, data)
+                    for workout_type, data in packages)
+
+
+def iter_packages_binary(buffer) -> Iterator[tuple]:
+    """Разобрать буфер пакетов без копирования в пары `(type, data)`."""
+    view = memoryview(buffer)
+    offset = 0
+    size = len(view)
+    while offset < size:
+        code = PACKET_HEADER.unpack_from(view, offset)[0]
+        if code not in PACKET_STRUCTS:
+            raise UnknownWorkoutError(code)
+        packet = PACKET_STRUCTS[code]
+        if offset + packet.size > size:
+            raise ValueError(f'Обрезанный пакет на смещении {offset}')
+        yield WORKOUT_NAMES[code], packet.unpack_from(view, offset)[1:]
+        offset += packet.size
+
+
+def read_packages_binary(buffer, batch: Optional[TrainingBatch] = None):
+    """Прочитать буфер бинарных пакетов.
+
+    Без `batch` возвращает список тренировок, иначе дописывает пакеты
+    в батч и возвращает его.
+    """
+    packages = iter_packages_binary(buffer)
+    if batch is None:
+        return [read_package(workout_type, data)
+                for workout_type, data in packages]
+    for workout_type, data in packages:
+        batch.append(workout_type, data)
+    return batch
+
+
+def iter_source(source) -> Iterator[str]:
+    """Лениво читать строки из файла, сокета, stdin (`'-'`) или пути."""
+    if source == '-':
+        yield from sys.stdin
+    elif isinstance(source, str):
+        with open(source, encoding='utf-8') as stream:
+            yield from stream
+    elif hasattr(source, 'makefile'):
+        with source.makefile('r', encoding='utf-8') as stream:
+            yield from stream
+    else:
+        yield from source
+
+
+def _load_package(line: str) -> tuple:
+    package = json.loads(line)
+    if (not isinstance(package, list) or len(package) != 2
+            or not isinstance(package[1], list)):
+        raise ValueError(f'Пакет должен иметь вид [тип, [параметры]]: '
+                         f'{line.strip()}')
+    return package[0], package[1]
+
+
+def parse_packages(lines: Iterable[str],
+                   errors: str = 'strict') -> Iterator[tuple]:
+    """Разобрать пакеты вида `["RUN", [15000, 1, 75]]` построчно.
+
+    С `errors='skip'` строка, которую не удалось разобрать, не прерывает
+    поток: вместо пакета выдаётся отказ `(None, line, reason)`.
+    """
+    for line in lines:
+        if line.strip():
+            try:
+                workout_type, data = _load_package(line)
+            except ValueError as error:
+                if errors == 'strict':
+                    raise
+                yield None, line.strip(), str(error)
+                continue
+            yield workout_type, data
+
+
+def read_trainings(packages: Iterable[tuple],
+                   reader: Callable = read_package) -> Iterator[Training]:
+    """Превратить пакеты в объекты тренировок."""
+    if INSTRUMENTATION is not None:
+        reader = INSTRUMENTATION.wrap('dispatch', reader,
+                                      label=_workout_name)
+    for workout_type, data in packages:
+        yield reader(workout_type, data)
+
+
+def compute_messages(trainings: Iterable[Training]) -> Iterator[InfoMessage]:
+    """Посчитать информационные сообщения для тренировок."""
+    if INSTRUMENTATION is not None:
+        yield from map(INSTRUMENTATION.wrap('compute', _show_training_info,
+                                            label=_class_name), trainings)
+        return
+    for training in trainings:
+        yield training.show_training_info()
+
+
+def _show_training_info(training: Training) -> InfoMessage:
+    return training.show_training_info()
+
+
+def format_messages(messages: Iterable[InfoMessage]) -> Iterator[str]:
+    """Отформатировать информационные сообщения."""
+    if INSTRUMENTATION is not None:
+        yield from map(INSTRUMENTATION.wrap('format', _get_message,
+                                            label=_training_type), messages)
+        return
+    for message in messages:
+        yield message.get_message()
+
+
+def _get_message(message: InfoMessage) -> str:
+    return message.get_message()
+
+
+def write_lines(lines: Iterable[str], stream=None) -> int:
+    """Записать строки в поток и вернуть их количество."""
+    stream = sys.stdout if stream is None else stream
+    write = stream.write
+    if INSTRUMENTATION is not None:
+        write = INSTRUMENTATION.wrap('output', write, label=_all)
+    count = 0
+    for line in lines:
+        write(line + '\n')
+        count += 1
+    return count
+
+
+def run_pipeline(source,
+                 parse: Optional[Callable] = parse_packages,
+                 read: Callable = read_trainings,
+                 compute: Callable = compute_messages,
+                 render: Callable = format_messages,
+                 sink: Callable = write_lines):
+    """Прогнать поток пакетов через цепочку ленивых стадий.
+
+    Каждая стадия принимает итератор и возвращает итератор, поэтому
+    следующий пакет читается из источника только тогда, когда приёмник
+    готов его принять, и память не зависит от длины потока. Если `parse`
+    равен `None`, источник уже выдаёт пары `(workout_type, data)`.
+    """
+    packages = iter(source) if parse is None else parse(iter_source(source))
+    return sink(render(compute(read(packages))))
+
+
+class ResultCache:
+    """Кэш информационных сообщений по содержимому пакета.
+
+    Повторный пакет с тем же `(workout_type, data)` возвращает уже
+    посчитанный `InfoMessage` без `read_package()`. Записей не больше
+    `maxsize`, вытесняется давно не использованная; с `ttl` запись
+    живёт не дольше `ttl` секунд. Сообщения общие для всех попаданий,
+    изменять их нельзя.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: Optional[float] = None,
+                 clock: Callable = time.monotonic) -> None:
+        self.maxsize: int = maxsize
+        self.ttl: Optional[float] = ttl
+        self.clock: Callable = clock
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_info(self, workout_type: str, data: list) -> InfoMessage:
+        """Вернуть сообщение о тренировке из кэша или посчитать его."""
+        key = (workout_type, tuple(data))
+        message = self._lookup(key)
+        if message is None:
+            message = read_package(workout_type, data).show_training_info()
+            self._store(key, message)
+        return message
+
+    def _lookup(self, key: tuple) -> Optional[InfoMessage]:
+        entry = self._entries.get(key)
+        if entry is not None and (entry[0] is None
+                                  or entry[0] > self.clock()):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def _store(self, key: tuple, message: InfoMessage) -> None:
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self._entries[key] = (expires, message)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def compute_messages(self,
+                         packages: Iterable[tuple]) -> Iterator[InfoMessage]:
+        """Стадия конвейера: `run_pipeline(..., read=iter, compute=...)`."""
+        for workout_type, data in packages:
+            yield self.get_info(workout_type, data)
+
+    def stats(self) -> dict:
+        """Статистика попаданий и вытеснений."""
+        total = self.hits + self.misses
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def clear(self) -> None:
+        """Очистить кэш и статистику."""
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+class ThreadSafeResultCache(ResultCache):
+    """`ResultCache` для одновременного использования из потоков.
+
+    Блокировка держится только на поиск и запись, сообщение при промахе
+    считается вне её. Потоки, одновременно промахнувшиеся по одному
+    пакету, посчитают его каждый сам.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._lock: threading.Lock = threading.Lock()
+
+    def _lookup(self, key: tuple) -> Optional[InfoMessage]:
+        with self._lock:
+            return super()._lookup(key)
+
+    def _store(self, key: tuple, message: InfoMessage) -> None:
+        with self._lock:
+            super()._store(key, message)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return super().stats()
+
+    def clear(self) -> None:
+        with self._lock:
+            super().clear()
+
+
+def process_shard(packages: list) -> list:
+    """Посчитать информационные сообщения для части пакетов."""
+    return [read_package(workout_type, data).show_training_info()
+            for workout_type, data in packages]
+
+
+def process_parallel(source: Iterable[tuple],
+                     workers: Optional[int] = None,
+                     chunk_size: int = 10000,
+                     ordered: bool = True,
+                     shard: Callable = process_shard) -> Iterator:
+    """Посчитать пакеты в нескольких процессах.
+
+    Источник режется на части по `chunk_size` пакетов, в работе держится
+    не больше двух частей на процесс. С `ordered=True` сообщения выдаются
+    в порядке входных пакетов, иначе по мере готовности частей. Часть
+    считается функцией `shard`, которая должна быть доступна дочерним
+    процессам и возвращать список результатов.
+    """
+    from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                    wait)
+
+    workers = workers or os.cpu_count() or 1
+    packages = iter(source)
+    pending: deque = deque()
+    with ProcessPoolExecutor(workers) as executor:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(itertools.islice(packages, chunk_size))
+                if not chunk:
+                    break
+                pending.append(executor.submit(shard, chunk))
+            if not pending:
+                return
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(wait(pending,
+                                        return_when=FIRST_COMPLETED).done))
+                pending.remove(future)
+            yield from future.result()
+
+
+def _compute_shared(name: str, rows: int, names: tuple) -> None:
+    from multiprocessing import resource_tracker, shared_memory
+
+    block = shared_memory.SharedMemory(name)
+    # Блоком владеет родительский процесс, он же его и удаляет.
+    resource_tracker.unregister(block._name, 'shared_memory')
+    view = block.buf.cast('d')
+    try:
+        columns = {column: view[k * rows:(k + 1) * rows]
+                   for k, column in enumerate(names)}
+        workout_types = [WORKOUT_NAMES[int(code)]
+                         for code in columns['code']]
+        result = process_batch(workout_types, columns)
+        offset = len(names) * rows
+        for k, field in enumerate(('distance', 'speed', 'calories')):
+            start = offset + k * rows
+            view[start:start + rows] = result[field]
+        for column in columns.values():
+            column.release()
+    finally:
+        view.release()
+        block.close()
+
+
+class SharedBatchWorker:
+    """Считает батчи пакетов в процессах через общую память.
+
+    Батч раскладывается по колонкам float64 в блоке
+    `multiprocessing.shared_memory`: коды видов тренировок, параметры
+    и место под дистанцию, скорость и калории. В процесс передаётся
+    только имя блока, поэтому тренировки не сериализуются.
+    """
+
+    def __init__(self, executor) -> None:
+        self.executor = executor
+        self.names: tuple = ('code',) + tuple(dict.fromkeys(
+            name for training in WORKOUT_TYPES.values()
+            for name in training.FIELDS
+        ))
+
+    def compute(self, packages: list) -> list:
+        """Посчитать батч пакетов и вернуть информационные сообщения."""
+        from multiprocessing import shared_memory
+
+        rows = len(packages)
+        width = len(self.names) + 3
+        block = shared_memory.SharedMemory(create=True, size=8 * rows * width)
+        view = block.buf.cast('d')
+        try:
+            positions = {name: k for k, name in enumerate(self.names)}
+            for row, (workout_type, data) in enumerate(packages):
+                training = check_package(workout_type, data)
+                view[row] = WORKOUT_CODES[workout_type]
+                for name, value in zip(training.FIELDS, data):
+                    view[positions[name] * rows + row] = value
+            self.executor.submit(_compute_shared, block.name, rows,
+                                 self.names).result()
+            offset = len(self.names) * rows
+            messages = [
+                InfoMessage(WORKOUT_TYPES[workout_type].__name__,
+                            data[1], view[offset + row],
+                            view[offset + rows + row],
+                            view[offset + 2 * rows + row])
+                for row, (workout_type, data) in enumerate(packages)
+            ]
+        finally:
+            view.release()
+            block.close()
+            block.unlink()
+        return messages
+
+
+_DONE = object()
+_POLL_SECONDS: float = 0.1
+
+
+def _put(target: queue.Queue, item, stop: threading.Event) -> bool:
+    """Положить в ограниченную очередь, пока не выставлен `stop`."""
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read_source(source: Iterable[tuple], inbox: queue.Queue,
+                 stop: threading.Event) -> None:
+    try:
+        for package in source:
+            if not _put(inbox, package, stop):
+                return
+    finally:
+        _put(inbox, _DONE, stop)
+
+
+def _dispatch_batches(inbox: queue.Queue, producers: int,
+                      worker: 'SharedBatchWorker', outbox: queue.Queue,
+                      batch_size: int, stop: threading.Event) -> None:
+    batch: list = []
+    try:
+        while producers and not stop.is_set():
+            try:
+                package = inbox.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if package is _DONE:
+                producers -= 1
+            else:
+                batch.append(package)
+            if batch and (len(batch) >= batch_size or not producers):
+                if stop.is_set():
+                    return
+                _put(outbox, worker.compute(batch), stop)
+                batch = []
+    except Exception as error:
+        _put(outbox, error, stop)
+    finally:
+        _put(outbox, _DONE, stop)
+
+
+def process_shared(sources: list, workers: Optional[int] = None,
+                   batch_size: int = 10000) -> Iterator[InfoMessage]:
+    """Читать источники в потоках и считать батчи в процессах.
+
+    Каждый источник читается своим потоком ввода-вывода и пишет пакеты
+    в очередь одного из `workers` потоков-раздатчиков без общих
+    блокировок между ними. Раздатчик копит батч до `batch_size` пакетов
+    и отдаёт его в процесс через `SharedBatchWorker`. Сообщения
+    выдаются по мере готовности батчей, порядок между источниками
+    не сохраняется.
+
+    Очереди ограничены: в очереди раздатчика не больше двух батчей
+    пакетов, в очереди готовых батчей не больше двух на раздатчика,
+    так что быстрый источник ждёт расчёта, а не копит память. Если
+    перестать читать результат раньше конца, потоки останавливаются.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    stop = threading.Event()
+    inboxes = [queue.Queue(2 * batch_size) for _ in range(workers)]
+    outbox: queue.Queue = queue.Queue(2 * workers)
+    with ProcessPoolExecutor(workers) as executor:
+        # Процессы запускаются до потоков, чтобы fork не застал
+        # чужие блокировки.
+        executor.submit(int).result()
+        worker = SharedBatchWorker(executor)
+        readers = [threading.Thread(target=_read_source, daemon=True,
+                                    args=(source, inboxes[i % workers], stop))
+                   for i, source in enumerate(sources)]
+        dispatchers = [threading.Thread(
+            target=_dispatch_batches, daemon=True,
+            args=(inbox, len(sources[k::workers]), worker, outbox,
+                  batch_size, stop)
+        ) for k, inbox in enumerate(inboxes)]
+        for thread in readers + dispatchers:
+            thread.start()
+        try:
+            running = workers
+            while running:
+                item = outbox.get()
+                if item is _DONE:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+        finally:
+            stop.set()
+            for thread in dispatchers:
+                thread.join()
+
+
+class LatencyStats:
+    """Скользящая выборка задержек обработки пакетов."""
+
+    def __init__(self, size: int = 100000) -> None:
+        self.samples: deque = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        """Добавить задержку одного пакета."""
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        """Вернуть `q`-й процентиль задержки в секундах."""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def summary(self) -> dict:
+        """Вернуть p50 и p99 задержки в миллисекундах."""
+        return {'count': len(self.samples),
+                'p50_ms': self.percentile(50) * 1000,
+                'p99_ms': self.percentile(99) * 1000}
+
+
+class PackageServer:
+    """Асинхронный сервер приёма пакетов от устройств.
+
+    Каждое соединение присылает пакеты построчно в формате
+    `parse_packages()` и получает в ответ по строке `get_message()`
+    на каждый пакет в том же порядке. Пакеты всех соединений копятся
+    в течение `window` секунд и считаются одним вызовом `process_batch()`
+    в `executor`, по умолчанию в пуле потоков цикла событий, чтобы батч
+    не останавливал приём соединений. Если батч целиком не посчитался,
+    например упал пул процессов, каждый его пакет получает ответ
+    `Ошибка: ...`, а сервер продолжает работу.
+    """
+
+    def __init__(self, window: float = 0.005, max_batch: int = 10000,
+                 executor: Optional['Executor'] = None) -> None:
+        self.window: float = window
+        self.max_batch: int = max_batch
+        self.executor: Optional['Executor'] = executor
+        self.latency: LatencyStats = LatencyStats()
+        self._queue: Optional['asyncio.Queue'] = None
+        self._batcher: Optional['asyncio.Task'] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0,
+                    path: Optional[str] = None) -> 'asyncio.AbstractServer':
+        """Запустить сервер на TCP-порту или Unix-сокете `path`."""
+        import asyncio
+
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self) -> None:
+        """Остановить обработку батчей.
+
+        Пакеты, которые ещё ждут ответа, отменяются, и их соединения
+        закрываются, а не зависают.
+        """
+        import asyncio
+
+        if self._batcher is not None:
+            self._batcher.cancel()
+            await asyncio.gather(self._batcher, return_exceptions=True)
+            self._batcher = None
+        while self._queue is not None and not self._queue.empty():
+            self._queue.get_nowait()[1].cancel()
+
+    async def handle(self, reader: 'asyncio.StreamReader',
+                     writer: 'asyncio.StreamWriter') -> None:
+        """Обслужить одно соединение устройства."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                started = time.perf_counter()
+                future = loop.create_future()
+                await self._queue.put((line, future))
+                writer.write(await future + b'\n')
+                await writer.drain()
+                self.latency.add(time.perf_counter() - started)
+        finally:
+            writer.close()
+
+    async def _run_batches(self) -> None:
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            try:
+                await asyncio.sleep(self.window)
+                while (not self._queue.empty()
+                       and len(items) < self.max_batch):
+                    items.append(self._queue.get_nowait())
+                try:
+                    replies = await loop.run_in_executor(
+                        self.executor, self.compute,
+                        [line for line, _ in items]
+                    )
+                except Exception as error:
+                    replies = [f'Ошибка: {error}'] * len(items)
+                for (_, future), reply in zip(items, replies):
+                    if not future.done():
+                        future.set_result(reply.encode('utf-8'))
+            finally:
+                for _, future in items:
+                    future.cancel()
+
+    @staticmethod
+    def compute(lines: list) -> list:
+        """Посчитать ответы для батча строк с пакетами."""
+        replies: list = [None] * len(lines)
+        packages: list = []
+        rows: list = []
+        for i, line in enumerate(lines):
+            try:
+                packages.append(next(parse_packages([line])))
+            except Exception as error:
+                replies[i] = f'Ошибка: {error}'
+                continue
+            rows.append(i)
+        try:
+            results = process_packages(packages, errors='skip')
+        except Exception:
+            results = [PackageServer._compute_one(package)
+                       for package in packages]
+        for i, result in zip(rows, results):
+            if isinstance(result, InfoMessage):
+                replies[i] = result.get_message()
+            elif isinstance(result, tuple):
+                replies[i] = f'Ошибка: {result[2]}'
+            else:
+                replies[i] = result
+        return replies
+
+    @staticmethod
+    def _compute_one(package: tuple) -> str:
+        try:
+            return read_package(*package).show_training_info().get_message()
+        except Exception as error:
+            return f'Ошибка: {error}'
+
+
+class QuantileSketch:
+    """Потоковая оценка квантилей с ограниченной памятью.
+
+    Значения раскладываются по логарифмическим корзинам, поэтому
+    квантиль оценивается с относительной погрешностью `accuracy`.
+    При переполнении `max_buckets` сливаются самые младшие корзины.
+    NaN и бесконечности не учитываются.
+    """
+    __slots__ = ('gamma', 'log_gamma', 'max_buckets', 'buckets',
+                 'zeros', 'count')
+
+    def __init__(self, accuracy: float = 0.01,
+                 max_buckets: int = 1024) -> None:
+        self.gamma: float = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma: float = math.log(self.gamma)
+        self.max_buckets: int = max_buckets
+        self.buckets: dict = {}
+        self.zeros: int = 0
+        self.count: int = 0
+
+    def add(self, value: float) -> None:
+        """Учесть одно значение, кроме NaN и бесконечностей."""
+        if not math.isfinite(value):
+            return
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            lowest = min(self.buckets)
+            count = self.buckets.pop(lowest)
+            lowest = min(self.buckets)
+            self.buckets[lowest] += count
+
+    def quantile(self, q: float) -> float:
+        """Оценить `q`-квантиль, `q` от 0 до 1."""
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def rank(self, value: float) -> float:
+        """Оценить долю значений не больше `value`, от 0 до 1."""
+        if not self.count or not value >= 0:
+            return 0.0
+        if value == math.inf:
+            return 1.0
+        seen = self.zeros
+        if value > 0:
+            limit = math.ceil(math.log(value) / self.log_gamma)
+            seen += sum(count for key, count in self.buckets.items()
+                        if key <= limit)
+        return seen / self.count
+
+
+class PeriodStats:
+    """Суммы, средние и квантили калорий за один период."""
+    __slots__ = ('count', 'duration', 'distance', 'calories', 'sketch')
+
+    def __init__(self, accuracy: float = 0.01) -> None:
+        self.count: int = 0
+        self.duration: float = 0.0
+        self.distance: float = 0.0
+        self.calories: float = 0.0
+        self.sketch: QuantileSketch = QuantileSketch(accuracy)
+
+    def add(self, message: InfoMessage) -> None:
+        """Учесть одну тренировку."""
+        self.count += 1
+        self.duration += message.duration
+        self.distance += message.distance
+        self.calories += message.calories
+        self.sketch.add(message.calories)
+
+    def mean(self, field: str) -> float:
+        """Среднее значение суммируемого поля за период."""
+        return getattr(self, field) / self.count if self.count else 0.0
+
+    def summary(self) -> dict:
+        return {'count': self.count,
+                'duration': self.duration,
+                'distance': self.distance,
+                'calories': self.calories,
+                'mean_calories': self.mean('calories'),
+                'p50_calories': self.sketch.quantile(0.5),
+                'p90_calories': self.sketch.quantile(0.9)}
+
+
+def _day(timestamp: float) -> int:
+    return int(timestamp // 86400)
+
+
+def _week(timestamp: float) -> int:
+    return (_day(timestamp) + 3) // 7
+
+
+def _month(timestamp: float) -> int:
+    moment = time.gmtime(timestamp)
+    return moment.tm_year * 12 + moment.tm_mon - 1
+
+
+class TrainingAggregator:
+    """Инкрементальные итоги по пользователям и видам тренировок.
+
+    Для каждой пары пользователь и вид тренировки хранится не больше
+    `keep` последних периодов каждого окна (сутки, неделя с понедельника,
+    календарный месяц по UTC). Добавление тренировки обновляет по одному
+    периоду каждого окна за O(keep). Опоздавшая тренировка старше всех
+    хранимых периодов заполненного окна в нём не учитывается.
+    """
+    WINDOWS: dict = {'day': _day, 'week': _week, 'month': _month}
+
+    def __init__(self, keep: int = 12, accuracy: float = 0.01) -> None:
+        self.keep: int = keep
+        self.accuracy: float = accuracy
+        self._periods: dict = {}
+
+    def add(self, user, message: InfoMessage,
+            timestamp: Optional[float] = None) -> None:
+        """Учесть тренировку пользователя, по умолчанию текущим временем."""
+        timestamp = time.time() if timestamp is None else timestamp
+        for window, period_of in self.WINDOWS.items():
+            key = (user, message.training_type, window)
+            periods = self._periods.get(key)
+            if periods is None:
+                periods = self._periods[key] = {}
+            period = period_of(timestamp)
+            stats = periods.get(period)
+            if stats is None:
+                if len(periods) >= self.keep:
+                    oldest = min(periods)
+                    if period < oldest:
+                        continue
+                    del periods[oldest]
+                stats = periods[period] = PeriodStats(self.accuracy)
+            stats.add(message)
+
+    def get(self, user, training_type: str, window: str,
+            timestamp: Optional[float] = None) -> PeriodStats:
+        """Итоги за период окна, в который попадает `timestamp`."""
+        timestamp = time.time() if timestamp is None else timestamp
+        periods = self._periods.get((user, training_type, window), {})
+        stats = periods.get(self.WINDOWS[window](timestamp))
+        return PeriodStats(self.accuracy) if stats is None else stats
+
+
+class Leaderboard:
+    """Лучшие результаты и процентильный ранг по видам тренировок.
+
+    Сообщения читаются за один проход. Для каждого вида тренировки
+    хранится куча из `k` лучших значений поля `field` и
+    `QuantileSketch`, так что память не зависит от длины потока.
+    """
+
+    def __init__(self, k: int = 10, field: str = 'calories',
+                 accuracy: float = 0.01) -> None:
+        self.k: int = k
+        self.field: str = field
+        self.accuracy: float = accuracy
+        self._heaps: dict = {}
+        self._sketches: dict = {}
+        self._order = itertools.count()
+
+    def add(self, user, message: InfoMessage) -> None:
+        """Учесть результат пользователя."""
+        value = getattr(message, self.field)
+        heap = self._heaps.get(message.training_type)
+        if heap is None:
+            heap = self._heaps[message.training_type] = []
+            self._sketches[message.training_type] = QuantileSketch(
+                self.accuracy
+            )
+        self._sketches[message.training_type].add(value)
+        item = (value, -next(self._order), user)
+        if len(heap) < self.k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def top(self, training_type: str) -> list:
+        """Пары `(user, value)` по убыванию, при равенстве раньше первый."""
+        return [(user, value) for value, _, user
+                in sorted(self._heaps.get(training_type, ()), reverse=True)]
+
+    def percentile_rank(self, training_type: str, value: float) -> float:
+        """Доля результатов вида тренировки не больше `value`."""
+        sketch = self._sketches.get(training_type)
+        return 0.0 if sketch is None else sketch.rank(value)
+
+
+RANK_RECORD = struct.Struct('<dqB')
+
+
+def _read_run(path: str, chunk_size: int = 4096) -> Iterator[tuple]:
+    with open(path, 'rb') as stream:
+        while True:
+            block = stream.read(RANK_RECORD.size * chunk_size)
+            if not block:
+                return
+            yield from RANK_RECORD.iter_unpack(block)
+
+
+def rank_results(results: Iterable[tuple], field: str = 'calories',
+                 run_size: int = 100000,
+                 directory: Optional[str] = None) -> Iterator[tuple]:
+    """Полный рейтинг `(value, user, training_type)` по убыванию `field`.
+
+    `results` — пары `(user, InfoMessage)` с целым `user`. Если
+    результатов больше `run_size`, отсортированные серии записываются
+    во временные файлы в `directory` записями `RANK_RECORD` и сливаются
+    `heapq.merge()`, так что в памяти одновременно не больше одной серии.
+    Равные значения упорядочены по убыванию `user`.
+    """
+    import tempfile
+
+    codes_by_name = {training.__name__: WORKOUT_CODES[workout_type]
+                     for workout_type, training in WORKOUT_TYPES.items()}
+    names = {code: WORKOUT_TYPES[workout_type].__name__
+             for code, workout_type in WORKOUT_NAMES.items()}
+    records = ((getattr(message, field), user,
+                codes_by_name[message.training_type])
+               for user, message in results)
+    with tempfile.TemporaryDirectory(dir=directory) as temp:
+        runs = []
+        for number, chunk in enumerate(iter_chunks(records, run_size)):
+            chunk.sort(reverse=True)
+            if number == 0 and len(chunk) < run_size:
+                runs.append(chunk)
+                break
+            path = os.path.join(temp, f'run{number:06d}.bin')
+            with open(path, 'wb') as stream:
+                stream.write(b''.join(itertools.starmap(RANK_RECORD.pack,
+                                                        chunk)))
+            runs.append(_read_run(path))
+        for value, user, code in heapq.merge(*runs, reverse=True):
+            yield value, user, names[code]
+
+
+class ResultColumns:
+    """Колонки хранилища результатов, отображённые в память.
+
+    Колонки — `memoryview` поверх `mmap` без копирования данных,
+    их нужно закрыть через `close()` или контекстный менеджер.
+    """
+
+    def __init__(self, store: 'ResultStore') -> None:
+        self._maps: list = []
+        self.codes: memoryview = self._map(store.path('training_type'), 'B')
+        self.size: int = len(self.codes)
+        self.columns: dict = {
+            name: self._map(store.path(name), 'd')[:self.size]
+            for name in store.COLUMNS
+        }
+        self.size = min([self.size] + [len(column)
+                                       for column in self.columns.values()])
+
+    def _map(self, path: str, typecode: str) -> memoryview:
+        with open(path, 'rb') as stream:
+            if not os.fstat(stream.fileno()).st_size:
+                return memoryview(array(typecode))
+            mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        view = memoryview(mapped)
+        size = len(view) // array(typecode).itemsize
+        return view[:size * array(typecode).itemsize].cast(typecode)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, name: str) -> memoryview:
+        return self.columns[name]
+
+    def total(self, name: str, workout_type: Optional[str] = None) -> float:
+        """Сумма колонки, при необходимости по одному виду тренировки."""
+        column = self.columns[name][:self.size]
+        if workout_type is None:
+            return math.fsum(column)
+        code = WORKOUT_CODES[workout_type]
+        return math.fsum(value for value, row_code
+                         in zip(column, self.codes) if row_code == code)
+
+    def close(self) -> None:
+        """Освободить отображения файлов."""
+        self.codes.release()
+        for column in self.columns.values():
+            column.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps.clear()
+
+    def __enter__(self) -> 'ResultColumns':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ResultStore:
+    """Колоночное хранилище результатов тренировок на диске.
+
+    Каждая колонка — отдельный файл в каталоге `directory`: коды видов
+    тренировок по байту на строку и float64 в порядке байт платформы
+    для `duration`, `distance`, `speed` и `calories`. Данные только
+    дописываются, а читаются через `open()` без создания `InfoMessage`.
+    """
+    COLUMNS: tuple = ('duration', 'distance', 'speed', 'calories')
+
+    def __init__(self, directory: str) -> None:
+        self.directory: str = directory
+        os.makedirs(directory, exist_ok=True)
+        for name in ('training_type',) + self.COLUMNS:
+            open(self.path(name), 'ab').close()
+
+    def path(self, name: str) -> str:
+        """Путь к файлу колонки."""
+        suffix = 'u8' if name == 'training_type' else 'f64'
+        return os.path.join(self.directory, f'{name}.{suffix}')
+
+    def __len__(self) -> int:
+        return os.path.getsize(self.path('training_type'))
+
+    def append(self, messages: Iterable[InfoMessage]) -> None:
+        """Дописать информационные сообщения."""
+        codes_by_name = {training.__name__: WORKOUT_CODES[workout_type]
+                         for workout_type, training in WORKOUT_TYPES.items()}
+        codes = array('B')
+        columns = {name: array('d') for name in self.COLUMNS}
+        for message in messages:
+            codes.append(codes_by_name[message.training_type])
+            for name, column in columns.items():
+                column.append(getattr(message, name))
+        self._write(codes, columns)
+
+    def append_batch(self, workout_types: list, result: dict) -> None:
+        """Дописать результат `process_batch()` без создания объектов."""
+        codes = array('B', [WORKOUT_CODES[workout_type]
+                            for workout_type in workout_types])
+        self._write(codes, {name: result[name] for name in self.COLUMNS})
+
+    def _write(self, codes: array, columns: dict) -> None:
+        for name, column in columns.items():
+            with open(self.path(name), 'ab') as stream:
+                array('d', column).tofile(stream)
+        with open(self.path('training_type'), 'ab') as stream:
+            codes.tofile(stream)
+
+    def open(self) -> ResultColumns:
+        """Отобразить колонки в память для чтения."""
+        return ResultColumns(self)
 
 
 def main(training: Training) -> None:
-    """Главная функция."""
+    """Главная функция.
+
+    Подходит и компактный вариант из `SLOTTED_WORKOUT_TYPES`, хотя он
+    не наследует `Training`.
+    """
     print(training.show_training_info().get_message())
 
 
-if __name__ == '__main__':
-    packages = [
-        ('SWM', [720, 1, 80, 25, 40]),
-        ('RUN', [15000, 1, 75]),
-        ('WLK', [9000, 1, 75, 180]),
-        ('NSW', [2, 3, 4, 1])
-    ]
+SAMPLE_PACKAGES: list = [
+    ('SWM', [720, 1, 80, 25, 40]),
+    ('RUN', [15000, 1, 75]),
+    ('WLK', [9000, 1, 75, 180]),
+    ('NSW', [2, 3, 4, 1])
+]
 
-    for workout_type, data in packages:
-        training = read_package(workout_type, data)
-        main(training)
+INPUT_FORMATS: dict = {'.csv': 'csv', '.bin': 'binary'}
+
+
+def parse_csv_packages(lines: Iterable[str],
+                       errors: str = 'strict') -> Iterator[tuple]:
+    """Разобрать пакеты вида `RUN,15000,1,75` построчно.
+
+    С `errors='skip'` строка с нечисловыми параметрами выдаётся как отказ
+    `(workout_type, data, reason)` с исходными строками параметров.
+    """
+    for row in csv.reader(lines):
+        if row:
+            try:
+                data = [float(value) for value in row[1:]]
+            except ValueError as error:
+                if errors == 'strict':
+                    raise
+                yield row[0], row[1:], str(error)
+                continue
+            yield row[0], data
+
+
+def read_file_packages(path: str, input_format: Optional[str] = None,
+                       errors: str = 'strict') -> Iterator[tuple]:
+    """Лениво читать пакеты из файла или stdin (`'-'`).
+
+    Формат определяется по расширению: `.csv`, `.bin` (бинарные пакеты,
+    файл отображается в память), остальное разбирается как NDJSON.
+    `errors` передаётся текстовым парсерам.
+    """
+    input_format = input_format or INPUT_FORMATS.get(
+        os.path.splitext(path)[1], 'ndjson'
+    )
+    if input_format == 'csv':
+        yield from parse_csv_packages(iter_source(path), errors)
+    elif input_format == 'ndjson':
+        yield from parse_packages(iter_source(path), errors)
+    elif path == '-':
+        yield from iter_packages_binary(sys.stdin.buffer.read())
+    else:
+        with open(path, 'rb') as stream:
+            if not os.fstat(stream.fileno()).st_size:
+                return
+            with mmap.mmap(stream.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                yield from iter_packages_binary(mapped)
+
+
+def _clip(value: float, low: float, high: float) -> float:
+    return min(max(value, low), high)
+
+
+def _draw_session(rng: 'random.Random', hours: float,
+                  speed: float, spread: float) -> tuple:
+    """Вес в кг, длительность в часах и дистанция в км одной тренировки."""
+    weight = round(_clip(rng.gauss(75.0, 12.0), 40.0, 150.0), 1)
+    duration = round(_clip(rng.lognormvariate(math.log(hours), 0.4),
+                           0.1, 4.0), 3)
+    speed = _clip(rng.gauss(speed, spread), speed / 2, speed * 2)
+    return weight, duration, duration * speed
+
+
+def generate_running(rng: 'random.Random') -> list:
+    weight, duration, distance = _draw_session(rng, 0.75, 10.0, 1.5)
+    steps = round(distance * Running.M_IN_KM / Running.LEN_STEP)
+    return [float(steps), duration, weight]
+
+
+def generate_walking(rng: 'random.Random') -> list:
+    weight, duration, distance = _draw_session(rng, 1.0, 6.0, 0.8)
+    steps = round(distance * SportsWalking.M_IN_KM / SportsWalking.LEN_STEP)
+    height = round(_clip(rng.gauss(172.0, 9.0), 140.0, 210.0), 1)
+    return [float(steps), duration, weight, height]
+
+
+def generate_swimming(rng: 'random.Random') -> list:
+    weight, duration, distance = _draw_session(rng, 0.7, 2.5, 0.5)
+    length_pool = 25.0 if rng.random() < 0.75 else 50.0
+    meters = distance * Swimming.M_IN_KM
+    strokes = round(meters / Swimming.LEN_STEP)
+    count_pool = float(max(1, round(meters / length_pool)))
+    return [float(strokes), duration, weight, length_pool, count_pool]
+
+
+WORKOUT_GENERATORS: dict = {
+    'SWM': generate_swimming,
+    'RUN': generate_running,
+    'WLK': generate_walking,
+}
+GENERATOR_MIX: dict = {'RUN': 0.5, 'WLK': 0.3, 'SWM': 0.2}
+
+
+def _generate_fresh(rng: 'random.Random', mix: dict, zero_duration: float,
+                    unknown_type: float) -> Iterator[tuple]:
+    workout_types = list(mix)
+    cum_weights = list(itertools.accumulate(mix.values()))
+    while True:
+        workout_type = rng.choices(workout_types, cum_weights=cum_weights)[0]
+        data = WORKOUT_GENERATORS[workout_type](rng)
+        if rng.random() < zero_duration:
+            data[1] = 0.0
+        if rng.random() < unknown_type:
+            workout_type = 'NSW'
+        yield workout_type, data
+
+
+def generate_packages(count: Optional[int] = None, seed: int = 0,
+                      mix: Optional[dict] = None, zero_duration: float = 0.0,
+                      unknown_type: float = 0.0,
+                      pool: int = 0) -> Iterator[tuple]:
+    """Сгенерировать воспроизводимый поток пакетов датчиков.
+
+    Один и тот же `seed` даёт одну и ту же последовательность. Виды
+    тренировок выбираются по долям из `mix`, параметры правдоподобны:
+    вес, рост, скорость и длительность распределены вокруг типичных
+    значений. Доли `zero_duration` и `unknown_type` портят пакеты
+    нулевой длительностью и неизвестным видом `NSW`.
+
+    С `pool > 0` генерируется `pool` разных пакетов, а дальше они
+    повторяются в случайном порядке: так поток идёт в десятки раз
+    быстрее, но пакеты (и их списки параметров) повторяются.
+    Без `count` поток бесконечен.
+    """
+    import random
+
+    rng = random.Random(seed)
+    packages = _generate_fresh(rng, mix or GENERATOR_MIX,
+                               zero_duration, unknown_type)
+    if pool:
+        base = list(itertools.islice(packages, pool))
+        packages = itertools.chain.from_iterable(
+            rng.choices(base, k=pool) for _ in itertools.repeat(None)
+        )
+    return itertools.islice(packages, count)
+
+
+def save_packages(packages: Iterable[tuple], path: str,
+                  output_format: Optional[str] = None,
+                  chunk_size: int = 4096) -> int:
+    """Записать пакеты в файл, который читает `read_file_packages()`.
+
+    Формат определяется по расширению так же, как при чтении. Пакеты
+    неизвестных видов нельзя записать в бинарный формат. Возвращает
+    число записанных пакетов.
+    """
+    output_format = output_format or INPUT_FORMATS.get(
+        os.path.splitext(path)[1], 'ndjson'
+    )
+    count = 0
+    binary = output_format == 'binary'
+    with open(path, 'wb' if binary else 'w',
+              **({} if binary else {'encoding': 'utf-8', 'newline': ''})
+              ) as stream:
+        writer = csv.writer(stream) if output_format == 'csv' else None
+        for chunk in iter_chunks(packages, chunk_size):
+            if binary:
+                stream.write(encode_packages(chunk))
+            elif writer is not None:
+                writer.writerows([workout_type, *data]
+                                 for workout_type, data in chunk)
+            else:
+                stream.writelines(json.dumps([workout_type, list(data)])
+                                  + '\n' for workout_type, data in chunk)
+            count += len(chunk)
+    return count
+
+
+def iter_chunks(items: Iterable, size: int) -> Iterator[list]:
+    """Нарезать поток на списки по `size` элементов."""
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_cli_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Посчитать тренировки из файлов с пакетами датчиков.'
+    )
+    parser.add_argument('files', nargs='*', default=['-'],
+                        help='файлы с пакетами, `-` для stdin')
+    parser.add_argument('--input-format', choices=('ndjson', 'csv', 'binary'),
+                        help='формат входа, по умолчанию по расширению')
+    parser.add_argument('--format', dest='output_format', default='text',
+                        choices=tuple(MESSAGE_FORMATS),
+                        help='формат вывода')
+    parser.add_argument('--output', help='файл вывода, по умолчанию stdout')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--errors', choices=('strict', 'skip'),
+                        default='skip',
+                        help='остановиться на плохом пакете или пропустить')
+    parser.add_argument('--dead-letter',
+                        help='NDJSON-файл для пропущенных пакетов')
+    parser.add_argument('--sample', action='store_true',
+                        help='посчитать встроенные образцовые пакеты')
+    parser.add_argument('--generate', type=int, metavar='COUNT',
+                        help='посчитать COUNT сгенерированных пакетов')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='зерно генератора для --generate')
+    return parser.parse_args(argv)
+
+
+def _accepted(results: Iterable, dead_letter, stats: dict) -> Iterator:
+    for result in results:
+        if not isinstance(result, tuple):
+            yield result
+            continue
+        stats['rejected'] += 1
+        if dead_letter is not None:
+            workout_type, data, reason = result
+            dead_letter.write(json.dumps(
+                {'workout_type': workout_type, 'data': data,
+                 'reason': reason}, ensure_ascii=False, default=list
+            ) + '\n')
+
+
+def cli(argv: Optional[list] = None) -> int:
+    """Точка входа командной строки, возвращает код завершения."""
+    args = parse_cli_args(argv)
+    if args.sample:
+        packages = iter(SAMPLE_PACKAGES)
+    elif args.generate is not None:
+        packages = generate_packages(args.generate, args.seed)
+    else:
+        packages = itertools.chain.from_iterable(
+            read_file_packages(path, args.input_format, args.errors)
+            for path in args.files
+        )
+    shard = functools.partial(process_packages, errors=args.errors)
+    if args.workers > 1:
+        results = process_parallel(packages, args.workers, args.batch_size,
+                                   shard=shard)
+    else:
+        results = itertools.chain.from_iterable(
+            map(shard, iter_chunks(packages, args.batch_size))
+        )
+    stats: dict = {'rejected': 0}
+    with contextlib.ExitStack() as stack:
+        output = (stack.enter_context(open(args.output, 'w',
+                                           encoding='utf-8'))
+                  if args.output else sys.stdout)
+        dead_letter = (stack.enter_context(open(args.dead_letter, 'w',
+                                                encoding='utf-8'))
+                       if args.dead_letter else None)
+        try:
+            write_messages(_accepted(results, dead_letter, stats),
+                           output, args.output_format)
+        except Exception as error:
+            print(f'Ошибка: {error}', file=sys.stderr)
+            return 1
+    if stats['rejected']:
+        print(f'Пропущено пакетов: {stats["rejected"]}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -1,7 +1,15 @@
+import asyncio
+import io
+import json
+import math
+import os
 import re
+import threading
 import pytest
 import types
 import inspect
+import itertools
+import time
 from collections import namedtuple
 from conftest import Capturing
 
@@ -451,3 +459,1095 @@ def test_main_output(input_data, expected):
     assert get_message_output == expected, (
         'Метод `main` должен печатать результат в консоль.\n'
     )
+
+
+BATCH_PACKAGES = [
+    ('SWM', [720, 1, 80, 25, 40]),
+    ('RUN', [15000, 1, 75]),
+    ('WLK', [9000, 1, 75, 180]),
+    ('RUN', [1206, 12, 6]),
+    ('WLK', [3000.33, 2.512, 75.8, 180.1]),
+    ('SWM', [1206, 12, 6, 12, 6]),
+]
+
+
+def test_process_batch():
+    workout_types, columns = homework.read_packages_columns(BATCH_PACKAGES)
+    result = homework.process_batch(workout_types, columns)
+    for i, (workout_type, data) in enumerate(BATCH_PACKAGES):
+        info = homework.read_package(workout_type, data).show_training_info()
+        for field in ('duration', 'distance', 'speed', 'calories'):
+            assert result[field][i] == getattr(info, field), (
+                'Функция `process_batch` должна возвращать те же значения, '
+                'что и `show_training_info`.'
+            )
+
+
+def test_process_batch_unknown_type():
+    with pytest.raises(homework.UnknownWorkoutError):
+        homework.process_batch(['NSW'], {'action': [2], 'duration': [3],
+                                         'weight': [4]})
+
+
+def test_run_pipeline():
+    source = io.StringIO(
+        '["SWM", [720, 1, 80, 25, 40]]\n'
+        '\n'
+        '["WLK", [9000, 1, 75, 180]]\n'
+    )
+    output = io.StringIO()
+    count = homework.run_pipeline(
+        source, sink=lambda lines: homework.write_lines(lines, output)
+    )
+    assert count == 2
+    assert output.getvalue().splitlines() == [
+        'Тип тренировки: Swimming; '
+        'Длительность: 1.000 ч.; '
+        'Дистанция: 0.994 км; '
+        'Ср. скорость: 1.000 км/ч; '
+        'Потрачено ккал: 336.000.',
+        'Тип тренировки: SportsWalking; '
+        'Длительность: 1.000 ч.; '
+        'Дистанция: 5.850 км; '
+        'Ср. скорость: 5.850 км/ч; '
+        'Потрачено ккал: 349.252.',
+    ], 'Конвейер должен печатать те же сообщения, что и `main`.'
+
+
+def test_run_pipeline_is_lazy():
+    consumed = []
+
+    def source():
+        for package in BATCH_PACKAGES:
+            consumed.append(package)
+            yield package
+
+    lines = homework.run_pipeline(source(), parse=None, sink=iter)
+    assert consumed == [], 'Стадии конвейера должны быть ленивыми.'
+    next(lines)
+    assert len(consumed) == 1
+
+
+@pytest.mark.parametrize('input_data', BATCH_PACKAGES)
+def test_slotted_trainings(input_data):
+    workout_type, data = input_data
+    training = homework.read_package(
+        workout_type, data, homework.SLOTTED_WORKOUT_TYPES
+    )
+    assert not hasattr(training, '__dict__'), (
+        'Компактные варианты тренировок должны использовать `__slots__`.'
+    )
+    info = training.show_training_info()
+    assert isinstance(info, homework.SlottedInfoMessage)
+    assert not hasattr(info, '__dict__')
+    expected = homework.read_package(*input_data).show_training_info()
+    assert info.get_message() == expected.get_message()
+
+
+def test_training_batch():
+    batch = homework.TrainingBatch.from_packages(BATCH_PACKAGES)
+    assert len(batch) == len(BATCH_PACKAGES)
+    assert batch.workout_types == [package[0] for package in BATCH_PACKAGES]
+    result = batch.compute()
+    for i, package in enumerate(BATCH_PACKAGES):
+        info = homework.read_package(*package).show_training_info()
+        assert result['calories'][i] == info.calories
+
+
+@pytest.mark.parametrize('input_data, field, value', [
+    (['RUN', [15000, 1, 75]], 'weight', 80),
+    (['RUN', [15000, 1, 75]], 'duration', 2),
+    (['WLK', [9000, 1, 75, 180]], 'height', 170),
+    (['WLK', [9000, 1, 75, 180]], 'action', 10000),
+    (['SWM', [720, 1, 80, 25, 40]], 'length_pool', 50),
+    (['SWM', [720, 1, 80, 25, 40]], 'count_pool', 20),
+])
+def test_cached_metrics_invalidation(input_data, field, value):
+    workout_type, data = input_data
+    training = homework.read_package(workout_type, data)
+    training.show_training_info()
+    setattr(training, field, value)
+    fields = homework.WORKOUT_TYPES[workout_type].FIELDS
+    changed = list(data)
+    changed[fields.index(field)] = value
+    expected = homework.read_package(workout_type, changed)
+    assert (training.show_training_info().get_message()
+            == expected.show_training_info().get_message()), (
+        'Изменение параметров тренировки должно сбрасывать кэш показателей.'
+    )
+
+
+def test_cached_metrics_computed_once(monkeypatch):
+    calls = []
+    get_distance = homework.Training.get_distance.__wrapped__
+
+    def counting_get_distance(self):
+        calls.append(self)
+        return get_distance(self)
+    monkeypatch.setattr(homework.Training, 'get_distance',
+                        homework.cached_metric(counting_get_distance))
+    training = homework.Running(15000, 1, 75)
+    training.show_training_info()
+    assert len(calls) == 1, 'Дистанция должна считаться один раз.'
+
+
+@pytest.mark.parametrize('workout_type, data', BATCH_PACKAGES)
+def test_kernel_matches_batch(workout_type, data):
+    cls = homework.WORKOUT_TYPES[workout_type]
+    assert cls.KERNEL.__code__.co_names == (), (
+        'Константы класса должны быть подставлены в `KERNEL`.'
+    )
+    columns = {name: [value] for name, value in zip(cls.FIELDS, data)}
+    expected = tuple(metric[0]
+                     for metric in cls.get_batch_metrics(columns, [0]))
+    assert cls.KERNEL(*data) == expected
+    assert homework.read_package(workout_type, data).get_metrics() == expected
+
+
+def test_kernel_rebuilt_for_subclass():
+    class SlowRunning(homework.Running):
+        CMF: int = 9
+
+    running = homework.Running(15000, 1, 75)
+    slow = SlowRunning(15000, 1, 75)
+    assert slow.KERNEL is not running.KERNEL
+    assert slow.get_distance() == running.get_distance()
+    assert slow.get_spent_calories() < running.get_spent_calories()
+
+
+def test_formula_override_reaches_batch_paths():
+    class FlatRunning(homework.Running):
+        FORMULAS = {**homework.Running.FORMULAS,
+                    'calories': 'speed * weight * duration'}
+
+    class PowerRunning(homework.Running):
+        FORMULAS = {**homework.Running.FORMULAS,
+                    'calories': 'speed ** 3 * weight'}
+
+    columns = {'action': [15000, 1206], 'duration': [1, 12],
+               'weight': [75, 6]}
+    for cls in (FlatRunning, PowerRunning):
+        calories = [cls(*row).get_spent_calories()
+                    for row in zip(*columns.values())]
+        assert list(cls.get_batch_metrics(columns, [0, 1])[2]) == calories, (
+            'Батч должен считать калории по тем же `FORMULAS`, '
+            'что и скалярное ядро.'
+        )
+        folded = cls.get_batch_folded(columns, [0, 1])[2]
+        assert list(folded) == pytest.approx(calories, rel=1e-12)
+    assert FlatRunning.COEFFICIENTS == {'speed': 1.0, 'base': 0.0,
+                                        'speed2_height': 0.0}
+    assert PowerRunning.COEFFICIENTS is None, (
+        'Нелинейная по скорости формула не должна сворачиваться.'
+    )
+
+
+def test_binary_packages_round_trip():
+    buffer = homework.encode_packages(BATCH_PACKAGES)
+    decoded = list(homework.iter_packages_binary(buffer))
+    assert [workout_type for workout_type, _ in decoded] == [
+        workout_type for workout_type, _ in BATCH_PACKAGES
+    ]
+    for (_, data), (_, expected) in zip(decoded, BATCH_PACKAGES):
+        assert list(data) == expected, (
+            'Декодированный пакет должен совпадать с исходным.'
+        )
+
+
+@pytest.mark.parametrize('input_data', BATCH_PACKAGES)
+def test_read_packages_binary(input_data):
+    buffer = homework.encode_package(*input_data)
+    training, = homework.read_packages_binary(buffer)
+    expected = homework.read_package(*input_data)
+    assert (training.show_training_info().get_message()
+            == expected.show_training_info().get_message())
+
+
+def test_read_packages_binary_batch():
+    buffer = bytearray(homework.encode_packages(BATCH_PACKAGES))
+    batch = homework.read_packages_binary(buffer, homework.TrainingBatch())
+    expected = homework.TrainingBatch.from_packages(BATCH_PACKAGES)
+    assert batch.codes == expected.codes
+    assert batch.columns == expected.columns
+
+
+def test_read_packages_binary_errors():
+    buffer = homework.encode_package('RUN', [15000, 1, 75])
+    with pytest.raises(ValueError):
+        homework.read_packages_binary(buffer[:-1])
+    with pytest.raises(homework.UnknownWorkoutError):
+        homework.read_packages_binary(b'\xff' + buffer[1:])
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_process_parallel(ordered):
+    packages = BATCH_PACKAGES * 5
+    messages = [
+        message.get_message()
+        for message in homework.process_parallel(
+            packages, workers=2, chunk_size=4, ordered=ordered
+        )
+    ]
+    expected = [message.get_message()
+                for message in homework.process_shard(packages)]
+    if ordered:
+        assert messages == expected, (
+            '`process_parallel` должен сохранять порядок пакетов.'
+        )
+    else:
+        assert sorted(messages) == sorted(expected)
+
+
+def test_package_server():
+    async def exchange():
+        server = homework.PackageServer(window=0.001)
+        threads = []
+
+        def compute(lines):
+            threads.append(threading.get_ident())
+            return homework.PackageServer.compute(lines)
+        server.compute = compute
+        listener = await server.start()
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(
+                b'["RUN", [15000, 1, 75]]\n'
+                b'["NSW", [2, 3, 4, 1]]\n'
+                b'["WLK", [9000, 1, 75, 180]]\n'
+            )
+            await writer.drain()
+            replies = [(await reader.readline()).decode('utf-8').rstrip()
+                       for _ in range(3)]
+            writer.close()
+            await writer.wait_closed()
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            await server.stop()
+        assert threading.get_ident() not in threads, (
+            'Батч должен считаться вне цикла событий.'
+        )
+        return replies, server.latency.summary()
+
+    replies, latency = asyncio.run(exchange())
+    assert replies[0] == homework.read_package(
+        'RUN', [15000, 1, 75]
+    ).show_training_info().get_message()
+    assert replies[1].startswith('Ошибка')
+    assert replies[2] == homework.read_package(
+        'WLK', [9000, 1, 75, 180]
+    ).show_training_info().get_message()
+    assert latency['count'] == 3
+    assert latency['p50_ms'] <= latency['p99_ms']
+
+
+def test_package_server_batch_failure():
+    async def exchange():
+        server = homework.PackageServer(window=0.001)
+        failures = [RuntimeError('пул сломан')]
+
+        def compute(lines):
+            if failures:
+                raise failures.pop()
+            return homework.PackageServer.compute(lines)
+        server.compute = compute
+        listener = await server.start()
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            replies = []
+            for _ in range(2):
+                writer.write(b'["RUN", [15000, 1, 75]]\n')
+                await writer.drain()
+                replies.append(await asyncio.wait_for(reader.readline(), 5))
+            server._batcher.cancel()
+            writer.write(b'["RUN", [15000, 1, 75]]\n')
+            await writer.drain()
+            await asyncio.sleep(0.01)
+            await server.stop()
+            closed = await asyncio.wait_for(reader.readline(), 5)
+            writer.close()
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            await server.stop()
+        return replies, closed
+
+    replies, closed = asyncio.run(exchange())
+    assert replies[0].decode('utf-8').startswith('Ошибка: пул сломан'), (
+        'Упавший батч должен отвечать ошибкой, а не зависать.'
+    )
+    assert replies[1].decode('utf-8').rstrip() == homework.read_package(
+        'RUN', [15000, 1, 75]
+    ).show_training_info().get_message()
+    assert closed == b'', 'Остановка должна закрывать ждущие соединения.'
+
+
+def test_render_messages_text():
+    messages = homework.process_shard(BATCH_PACKAGES)
+    assert homework.render_messages(messages).splitlines() == [
+        message.get_message() for message in messages
+    ], 'Пакетное форматирование должно совпадать с `get_message`.'
+
+
+def test_render_ndjson_non_finite():
+    message = homework.InfoMessage('Running', 1.5, math.nan, math.inf, 2.0)
+    line = homework.render_messages([message], 'ndjson')
+    assert json.loads(line, parse_constant=pytest.fail) == {
+        'training_type': 'Running', 'duration': 1.5, 'distance': None,
+        'speed': None, 'calories': 2.0
+    }, 'NaN и бесконечность должны выводиться в NDJSON как null.'
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'ndjson'])
+def test_write_messages_machine_readable(fmt, tmp_path):
+    messages = homework.process_shard(BATCH_PACKAGES)
+    path = tmp_path / f'messages.{fmt}'
+    with open(path, 'w', encoding='utf-8') as stream:
+        count = homework.write_messages(messages, stream, fmt, chunk_size=4)
+    assert count == len(messages)
+    lines = path.read_text(encoding='utf-8').splitlines()
+    if fmt == 'csv':
+        header, *lines = lines
+        assert header.split(',') == list(homework.InfoMessage.FIELDS)
+        rows = [line.split(',') for line in lines]
+    else:
+        rows = [list(json.loads(line).values()) for line in lines]
+    for row, message in zip(rows, messages):
+        assert row[0] == message.training_type
+        assert [float(value) for value in row[1:]] == [
+            message.duration, message.distance,
+            message.speed, message.calories
+        ]
+
+
+def test_write_messages_fd(tmp_path):
+    messages = homework.process_shard(BATCH_PACKAGES)
+    path = tmp_path / 'messages.txt'
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        homework.write_messages(messages, fd)
+    finally:
+        os.close(fd)
+    assert path.read_text(encoding='utf-8') == homework.render_messages(
+        messages
+    )
+
+
+@pytest.fixture
+def registry():
+    registries = (homework.WORKOUT_TYPES, homework.WORKOUT_CODES,
+                  homework.WORKOUT_NAMES, homework.PACKET_STRUCTS,
+                  homework.SLOTTED_WORKOUT_TYPES)
+    saved = [dict(registry) for registry in registries]
+    yield
+    for registry, items in zip(registries, saved):
+        registry.clear()
+        registry.update(items)
+
+
+def test_read_package_unknown_workout():
+    with pytest.raises(homework.UnknownWorkoutError) as error:
+        homework.read_package('NSW', [2, 3, 4, 1])
+    assert error.value.workout_type == 'NSW'
+
+
+@pytest.mark.parametrize('input_data', [
+    ('RUN', [15000, 1]),
+    ('WLK', [9000, 1, 75]),
+    ('SWM', [720, 1, 80, 25, 40, 1]),
+])
+def test_read_package_wrong_length(input_data):
+    with pytest.raises(homework.PackageLengthError):
+        homework.read_package(*input_data)
+
+
+def test_register_workout(registry):
+    @homework.register_workout('NRD', 42)
+    class NordicWalking(homework.SportsWalking):
+        LEN_STEP: float = 0.8
+
+    training = homework.read_package('NRD', [9000, 1, 75, 180])
+    assert isinstance(training, NordicWalking)
+    assert training.get_distance() == 9000 * 0.8 / 1000
+    buffer = homework.encode_package('NRD', [9000, 1, 75, 180])
+    decoded, = homework.read_packages_binary(buffer)
+    assert isinstance(decoded, NordicWalking)
+    slotted = homework.read_package('NRD', [9000, 1, 75, 180],
+                                    homework.SLOTTED_WORKOUT_TYPES)
+    assert not hasattr(slotted, '__dict__')
+    assert slotted.SLOTTED_FROM is NordicWalking
+    assert slotted.show_training_info().get_message() == (
+        training.show_training_info().get_message()
+    ), 'Компактный вариант должен создаваться при регистрации.'
+    with pytest.raises(ValueError):
+        homework.register_workout('NRD', 43)(NordicWalking)
+
+
+def test_quantile_sketch():
+    sketch = homework.QuantileSketch(accuracy=0.01)
+    for value in range(1, 10001):
+        sketch.add(value)
+    for q in (0.1, 0.5, 0.9, 0.99):
+        expected = q * 9999 + 1
+        assert abs(sketch.quantile(q) - expected) <= expected * 0.011, (
+            'Квантиль должен оцениваться с заданной точностью.'
+        )
+
+
+def test_quantile_sketch_bounded():
+    sketch = homework.QuantileSketch(max_buckets=16)
+    for value in range(1, 10001):
+        sketch.add(value)
+    assert len(sketch.buckets) <= 16
+    assert sketch.count == 10000
+
+
+def test_quantile_sketch_non_finite():
+    sketch = homework.QuantileSketch()
+    for value in (1.0, math.nan, math.inf, 2.0):
+        sketch.add(value)
+    assert sketch.count == 2, 'NaN и бесконечности не должны учитываться.'
+    assert sketch.rank(math.inf) == 1.0
+    assert sketch.rank(math.nan) == 0.0
+    stats = homework.PeriodStats()
+    stats.add(homework.InfoMessage('Running', 1, 1, 1, math.nan))
+    assert stats.sketch.count == 0
+
+
+def test_training_aggregator():
+    aggregator = homework.TrainingAggregator(keep=2)
+    messages = homework.process_shard(BATCH_PACKAGES)
+    day = 86400
+    monday = 4 * day
+    for i, message in enumerate(messages):
+        aggregator.add('user', message, monday + i * day)
+    running = [message for message in messages
+               if message.training_type == 'Running']
+    week = aggregator.get('user', 'Running', 'week', monday)
+    assert week.count == len(running)
+    assert week.calories == sum(message.calories for message in running)
+    assert week.mean('distance') == (
+        sum(message.distance for message in running) / len(running)
+    )
+    daily = aggregator.get('user', 'Running', 'day', monday + day)
+    assert daily.count == 1
+    aggregator.add('user', running[0], monday + 5 * day)
+    assert aggregator.get('user', 'Running', 'day', monday + day).count == 0, (
+        'Агрегатор должен хранить ограниченное число периодов.'
+    )
+    assert aggregator.get('other', 'Running', 'month', monday).count == 0
+    aggregator.add('user', running[0], monday)
+    assert aggregator.get('user', 'Running', 'day', monday).count == 0, (
+        'Опоздавшая тренировка не должна возвращать вытесненный период.'
+    )
+    assert aggregator.get('user', 'Running', 'day', monday + 5 * day).count
+
+
+def test_leaderboard():
+    messages = homework.process_shard(
+        list(homework.generate_packages(2000, seed=5))
+    )
+    leaderboard = homework.Leaderboard(k=5)
+    for user, message in enumerate(messages):
+        leaderboard.add(user, message)
+    for training_type in ('Running', 'SportsWalking', 'Swimming'):
+        results = sorted(((message.calories, -user, user)
+                          for user, message in enumerate(messages)
+                          if message.training_type == training_type),
+                         reverse=True)
+        assert leaderboard.top(training_type) == [
+            (user, calories) for calories, _, user in results[:5]
+        ], 'Лидеры должны совпадать с полной сортировкой.'
+        median = results[len(results) // 2][0]
+        assert leaderboard.percentile_rank(training_type, median) == (
+            pytest.approx(0.5, abs=0.02)
+        )
+    assert leaderboard.top('Cycling') == []
+
+
+@pytest.mark.parametrize('run_size', [100, 100000])
+def test_rank_results(tmp_path, run_size):
+    messages = homework.process_shard(
+        list(homework.generate_packages(1000, seed=6))
+    )
+    ranking = list(homework.rank_results(enumerate(messages), 'distance',
+                                         run_size, str(tmp_path)))
+    assert ranking == sorted(((message.distance, user, message.training_type)
+                              for user, message in enumerate(messages)),
+                             reverse=True)
+    assert list(tmp_path.iterdir()) == [], (
+        'Временные серии должны удаляться после слияния.'
+    )
+
+
+def test_result_store(tmp_path):
+    store = homework.ResultStore(str(tmp_path / 'results'))
+    with store.open() as columns:
+        assert len(columns) == 0
+    messages = homework.process_shard(BATCH_PACKAGES)
+    store.append(messages)
+    workout_types, columns = homework.read_packages_columns(BATCH_PACKAGES)
+    store.append_batch(workout_types,
+                       homework.process_batch(workout_types, columns))
+    assert len(store) == 2 * len(messages)
+    with store.open() as columns:
+        assert len(columns) == 2 * len(messages)
+        assert list(columns['calories']) == [
+            message.calories for message in messages
+        ] * 2, 'Хранилище должно возвращать записанные значения.'
+        assert columns.total('distance', 'RUN') == 2 * sum(
+            message.distance for message in messages
+            if message.training_type == 'Running'
+        )
+
+
+@pytest.fixture
+def instrumentation():
+    yield homework.enable_instrumentation()
+    homework.disable_instrumentation()
+
+
+def test_instrumentation(instrumentation, tmp_path):
+    output = io.StringIO()
+    homework.run_pipeline(
+        BATCH_PACKAGES, parse=None,
+        sink=lambda lines: homework.write_lines(lines, output)
+    )
+    homework.process_batch(*homework.read_packages_columns(BATCH_PACKAGES))
+    items = instrumentation.items
+    assert items['dispatch', 'Running'] == 2
+    assert items['compute', 'Swimming'] == 2 + 2, (
+        'Конвейер и батч должны помечать вид тренировки одинаково.'
+    )
+    assert items['format', 'SportsWalking'] == 2
+    assert {label for _, label in items} == {
+        'Running', 'SportsWalking', 'Swimming', 'all'
+    }
+    assert items['output', 'all'] == len(BATCH_PACKAGES)
+    text = instrumentation.to_prometheus()
+    assert ('fitness_stage_seconds_count{stage="dispatch",workout="Running"} 2'
+            in text)
+    path = tmp_path / 'metrics.json'
+    instrumentation.dump(str(path))
+    snapshot = json.loads(path.read_text(encoding='utf-8'))
+    dispatch = next(entry for entry in snapshot
+                    if (entry['stage'], entry['workout'])
+                    == ('dispatch', 'Running'))
+    assert dispatch['items'] == dispatch['count'] == 2
+
+
+def test_instrumentation_disabled():
+    assert homework.INSTRUMENTATION is None
+    homework.run_pipeline(BATCH_PACKAGES, parse=None, sink=list)
+    assert homework.INSTRUMENTATION is None
+
+
+def test_result_cache_lru():
+    cache = homework.ResultCache(maxsize=2)
+    first = cache.get_info('RUN', [15000, 1, 75])
+    assert cache.get_info('RUN', [15000, 1, 75]) is first
+    cache.get_info('WLK', [9000, 1, 75, 180])
+    cache.get_info('RUN', [15000, 1, 75])
+    cache.get_info('SWM', [720, 1, 80, 25, 40])
+    assert len(cache) == 2
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 3,
+                             'evictions': 1, 'hit_rate': 0.4}
+    cache.get_info('WLK', [9000, 1, 75, 180])
+    assert cache.misses == 4, (
+        'Вытесняться должна давно не использованная запись.'
+    )
+
+
+def test_result_cache_ttl():
+    now = [0.0]
+    cache = homework.ResultCache(ttl=10, clock=lambda: now[0])
+    first = cache.get_info('RUN', [15000, 1, 75])
+    now[0] = 9
+    assert cache.get_info('RUN', [15000, 1, 75]) is first
+    now[0] = 10
+    assert cache.get_info('RUN', [15000, 1, 75]) is not first
+    assert cache.misses == 2
+
+
+def test_thread_safe_result_cache():
+    cache = homework.ThreadSafeResultCache(maxsize=4)
+    packages = BATCH_PACKAGES * 50
+
+    def work():
+        for message in cache.compute_messages(packages):
+            message.get_message()
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 4 * len(packages)
+    assert stats['size'] <= 4
+
+
+def test_thread_safe_result_cache_computes_outside_lock(monkeypatch):
+    cache = homework.ThreadSafeResultCache()
+    cached = cache.get_info('RUN', [15000, 1, 75])
+    started, release = threading.Event(), threading.Event()
+    read_package = homework.read_package
+
+    def slow_read_package(workout_type, data):
+        started.set()
+        release.wait(5)
+        return read_package(workout_type, data)
+    monkeypatch.setattr(homework, 'read_package', slow_read_package)
+    miss = threading.Thread(target=cache.get_info,
+                            args=('WLK', [9000, 1, 75, 180]))
+    miss.start()
+    assert started.wait(5)
+    hits = []
+    hit = threading.Thread(target=lambda: hits.append(
+        cache.get_info('RUN', [15000, 1, 75])
+    ))
+    try:
+        hit.start()
+        hit.join(1)
+        assert hits == [cached], 'Попадание не должно ждать чужого расчёта.'
+    finally:
+        release.set()
+        miss.join()
+        hit.join()
+    assert len(cache) == 2
+
+
+INVALID_PACKAGES = [
+    ('RUN', [15000, 0, 75]),
+    ('WLK', [9000, 1, 75, 0]),
+    ('SWM', [720, 1, float('nan'), 25, 40]),
+    ('RUN', [-1, 1, 75]),
+    ('WLK', [9000, float('inf'), 75, 180]),
+]
+
+
+def invalid_batch():
+    workout_types, columns = homework.read_packages_columns(
+        BATCH_PACKAGES + INVALID_PACKAGES
+    )
+    workout_types.append('NSW')
+    for column in columns.values():
+        column.append(1)
+    return workout_types, columns
+
+
+def test_validate_batch():
+    workout_types, columns = invalid_batch()
+    clean, rejects = homework.validate_batch(workout_types, columns)
+    assert clean == list(range(len(BATCH_PACKAGES)))
+    assert [row for row, _, _ in rejects] == list(
+        range(len(BATCH_PACKAGES), len(workout_types))
+    ), 'Все плохие пакеты должны попасть в отказы.'
+    reasons = [reason for _, _, reason in rejects]
+    assert reasons[0].startswith('duration')
+    assert reasons[1].startswith('height')
+    assert reasons[2].startswith('weight')
+    assert reasons[3].startswith('action')
+    assert reasons[4].startswith('duration')
+    assert 'NSW' in reasons[5]
+
+
+def test_process_batch_dead_letter():
+    workout_types, columns = invalid_batch()
+    dead_letter = []
+    result = homework.process_batch(workout_types, columns, dead_letter)
+    assert len(dead_letter) == len(INVALID_PACKAGES) + 1
+    for i, package in enumerate(BATCH_PACKAGES):
+        info = homework.read_package(*package).show_training_info()
+        assert result['calories'][i] == info.calories
+    for row, _, _ in dead_letter:
+        assert math.isnan(result['calories'][row])
+
+
+def test_process_batch_folded():
+    workout_types, columns = homework.read_packages_columns(BATCH_PACKAGES)
+    exact = homework.process_batch(workout_types, columns)
+    folded = homework.process_batch(workout_types, columns, exact=False)
+    for field in ('distance', 'speed', 'calories'):
+        for value, expected in zip(folded[field], exact[field]):
+            assert value == pytest.approx(expected, rel=1e-12), (
+                'Свёрнутые коэффициенты должны давать тот же результат '
+                'с точностью до округлений.'
+            )
+
+
+def test_process_batch_single_precision():
+    packages = BATCH_PACKAGES + list(homework.generate_packages(20000,
+                                                                seed=4))
+    reference = homework.TrainingBatch.from_packages(packages).compute()
+    batch = homework.TrainingBatch.from_packages(packages, 'single')
+    assert batch.columns['action'].typecode == 'f'
+    result = batch.compute()
+    for field in homework.RESULT_FIELDS:
+        assert result[field].typecode == 'f'
+        assert result[field].itemsize * 2 == reference[field].itemsize
+        error = max(abs(value - expected) / expected for value, expected
+                    in zip(result[field], reference[field]))
+        assert error <= homework.SINGLE_PRECISION_ERROR, (
+            'Погрешность float32 должна укладываться в заявленную.'
+        )
+
+
+def test_process_batch_single_precision_rounding():
+    packages = list(homework.generate_packages(20000, seed=4))
+    reference = homework.TrainingBatch.from_packages(packages).compute()
+    result = homework.TrainingBatch.from_packages(packages, 'single').compute()
+    changed = 0
+    for field in homework.RESULT_FIELDS:
+        for value, expected in zip(result[field], reference[field]):
+            assert abs(value - expected) <= (
+                expected * homework.SINGLE_PRECISION_ERROR
+            )
+            shown, shown_expected = f'{value:.3f}', f'{expected:.3f}'
+            assert abs(float(shown) - float(shown_expected)) < 0.0011, (
+                'Последний знак может расходиться не больше чем на единицу.'
+            )
+            changed += shown != shown_expected and expected < 500
+    assert changed, (
+        'Последний знак может расходиться и у значений меньше 500.'
+    )
+
+
+@pytest.mark.parametrize('workout_type, rows, weight, height', [
+    ('RUN', [[15000, 1], [1206, 12], [420, 4]], 75, None),
+    ('WLK', [[9000, 1], [3000.33, 2.512]], 75.8, 180.1),
+    ('SWM', [[720, 1, 25, 40], [1206, 12, 12, 6]], 80, None),
+])
+def test_process_user_history(workout_type, rows, weight, height):
+    fields = [name for name in homework.WORKOUT_TYPES[workout_type].FIELDS
+              if name not in ('weight', 'height')]
+    columns = {name: [row[j] for row in rows]
+               for j, name in enumerate(fields)}
+    result = homework.process_user_history(workout_type, columns,
+                                           weight, height)
+    for i, row in enumerate(rows):
+        data = row[:2] + [weight] + ([height] if height else []) + row[2:]
+        info = homework.read_package(workout_type, data).show_training_info()
+        assert result['calories'][i] == pytest.approx(info.calories,
+                                                      rel=1e-12)
+
+
+def test_process_user_history_errors():
+    columns = {'action': [9000], 'duration': [1]}
+    with pytest.raises(homework.UnknownWorkoutError):
+        homework.process_user_history('NSW', columns, 75)
+    with pytest.raises(ValueError, match='нужен рост'):
+        homework.process_user_history('WLK', columns, 75)
+
+
+def replay_history(packages, weight, height):
+    calories = []
+    for workout_type, data in packages:
+        fields = homework.WORKOUT_TYPES[workout_type].FIELDS
+        profile = {'weight': weight, 'height': height}
+        data = [profile.get(name, value) for name, value in zip(fields, data)]
+        training = homework.read_package(workout_type, data)
+        calories.append(training.show_training_info().calories)
+    return calories
+
+
+def test_user_history_update_profile():
+    packages = list(homework.generate_packages(3000, seed=9))
+    history = homework.UserHistory(75, 180)
+    for chunk in homework.iter_chunks(packages, 1000):
+        history.extend(*homework.read_packages_columns(chunk))
+    assert len(history) == len(packages)
+    assert list(history['calories']) == pytest.approx(
+        replay_history(packages, 75, 180), rel=1e-12
+    )
+    calories = history.update_profile(weight=68.5)
+    assert list(calories) == pytest.approx(
+        replay_history(packages, 68.5, 180), rel=1e-12
+    ), 'Пересчёт по профилю должен совпадать с полным повтором истории.'
+    history.update_profile(height=171)
+    assert list(history['calories']) == pytest.approx(
+        replay_history(packages, 68.5, 171), rel=1e-12
+    )
+    before = list(history['calories'])
+    with pytest.raises(ValueError):
+        history.update_profile(weight=80, height=0)
+    assert (history.weight, history.height) == (68.5, 171), (
+        'Неудачный пересчёт не должен менять профиль.'
+    )
+    assert list(history['calories']) == before
+    with pytest.raises(ValueError):
+        homework.UserHistory(75).extend(
+            *homework.read_packages_columns([('WLK', [9000, 1, 75, 180])])
+        )
+
+
+def write_cli_inputs(tmp_path):
+    packages = BATCH_PACKAGES + [('NSW', [2, 3, 4, 1]),
+                                 ('RUN', [15000, 0, 75])]
+    ndjson = tmp_path / 'packages.ndjson'
+    ndjson.write_text(''.join(json.dumps(package) + '\n'
+                              for package in packages), encoding='utf-8')
+    csv_path = tmp_path / 'packages.csv'
+    csv_path.write_text(''.join(
+        ','.join([workout_type] + [str(value) for value in data]) + '\n'
+        for workout_type, data in packages
+    ), encoding='utf-8')
+    binary = tmp_path / 'packages.bin'
+    binary.write_bytes(homework.encode_packages(BATCH_PACKAGES))
+    return ndjson, csv_path, binary
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_cli(tmp_path, workers):
+    ndjson, csv_path, binary = write_cli_inputs(tmp_path)
+    output = tmp_path / 'out.txt'
+    dead_letter = tmp_path / 'dead.ndjson'
+    code = homework.cli([str(ndjson), str(csv_path), str(binary),
+                         '--output', str(output),
+                         '--dead-letter', str(dead_letter),
+                         '--workers', str(workers), '--batch-size', '3'])
+    assert code == 0
+    expected = [homework.read_package(*package).show_training_info()
+                .get_message() for package in BATCH_PACKAGES]
+    assert output.read_text(encoding='utf-8').splitlines() == expected * 3, (
+        'Командная строка должна печатать сообщения всех входных файлов.'
+    )
+    rejects = [json.loads(line) for line in
+               dead_letter.read_text(encoding='utf-8').splitlines()]
+    assert [reject['workout_type'] for reject in rejects] == [
+        'NSW', 'RUN', 'NSW', 'RUN'
+    ]
+
+
+def test_cli_skips_malformed_lines(tmp_path, capsys):
+    ndjson = tmp_path / 'packages.ndjson'
+    ndjson.write_text('["RUN", [15000, 1, 75]]\n'
+                      'not json\n'
+                      '["RUN", [15000, 1, "x"]]\n'
+                      'null\n'
+                      '["WLK", [9000, 1, 75, 180]]\n', encoding='utf-8')
+    csv_path = tmp_path / 'packages.csv'
+    csv_path.write_text('RUN,abc,1,75\nRUN,15000,1,75\n', encoding='utf-8')
+    output = tmp_path / 'out.txt'
+    dead_letter = tmp_path / 'dead.ndjson'
+    code = homework.cli([str(ndjson), str(csv_path),
+                         '--output', str(output),
+                         '--dead-letter', str(dead_letter)])
+    assert code == 0, 'Плохие строки не должны прерывать обработку.'
+    expected = [homework.read_package(*package).show_training_info()
+                .get_message() for package in (
+                    ('RUN', [15000, 1, 75]), ('WLK', [9000, 1, 75, 180]),
+                    ('RUN', [15000, 1, 75]))]
+    assert output.read_text(encoding='utf-8').splitlines() == expected
+    rejects = [json.loads(line) for line in
+               dead_letter.read_text(encoding='utf-8').splitlines()]
+    assert [reject['data'] for reject in rejects] == [
+        'not json', [15000, 1, 'x'], 'null', ['abc', '1', '75']
+    ]
+    assert 'Пропущено пакетов: 4' in capsys.readouterr().err
+
+
+def test_batch_errors_non_numbers():
+    columns = {'action': [15000, 'x', None], 'duration': [1, 1, 1],
+               'weight': [75, 75, 75]}
+    errors = homework.Running.get_batch_errors(columns, [0, 1, 2])
+    assert sorted(errors) == [1, 2], (
+        'Не числа должны становиться причиной отказа, а не исключением.'
+    )
+
+
+def test_cli_strict(tmp_path, capsys):
+    ndjson, _, _ = write_cli_inputs(tmp_path)
+    assert homework.cli([str(ndjson), '--errors', 'strict',
+                         '--format', 'csv']) == 1
+    assert 'Ошибка' in capsys.readouterr().err
+
+
+def test_cli_sample(capsys):
+    assert homework.cli(['--sample']) == 0
+    captured = capsys.readouterr()
+    assert len(captured.out.splitlines()) == 3
+    assert 'Пропущено пакетов: 1' in captured.err
+
+
+@pytest.mark.parametrize('pool', [0, 100])
+def test_generate_packages(pool):
+    packages = list(homework.generate_packages(
+        5000, seed=7, zero_duration=0.1, unknown_type=0.05, pool=pool
+    ))
+    assert packages == list(homework.generate_packages(
+        5000, seed=7, zero_duration=0.1, unknown_type=0.05, pool=pool
+    )), 'Один и тот же seed должен давать те же пакеты.'
+    assert packages != list(homework.generate_packages(
+        5000, seed=8, zero_duration=0.1, unknown_type=0.05, pool=pool
+    ))
+    rejects = [result for result in homework.process_packages(packages,
+                                                              'skip')
+               if isinstance(result, tuple)]
+    assert 0.1 < len(rejects) / len(packages) < 0.2
+    assert {workout_type for workout_type, _ in packages} == {
+        'SWM', 'RUN', 'WLK', 'NSW'
+    }
+
+
+@pytest.mark.parametrize('name', ['packages.ndjson', 'packages.csv',
+                                  'packages.bin'])
+def test_save_packages(tmp_path, name):
+    packages = list(homework.generate_packages(1000, seed=1))
+    path = str(tmp_path / name)
+    assert homework.save_packages(packages, path, chunk_size=300) == 1000
+    assert [(workout_type, list(data)) for workout_type, data
+            in homework.read_file_packages(path)] == packages
+
+
+def test_cli_generate(capsys):
+    assert homework.cli(['--generate', '50', '--seed', '3']) == 0
+    expected = [homework.read_package(*package).show_training_info()
+                .get_message()
+                for package in homework.generate_packages(50, seed=3)]
+    assert capsys.readouterr().out.splitlines() == expected
+
+
+def test_track_training():
+    samples = 3601
+    timestamps = list(range(samples))
+    latitudes = [55.0 + i / (samples - 1) * 0.09 for i in range(samples)]
+    longitudes = [37.0] * samples
+    heart_rates = [150] * samples
+    whole = homework.TrackRunning(75, 30)
+    whole.feed(timestamps, latitudes, longitudes, heart_rates)
+    chunked = homework.TrackRunning(75, 30)
+    for start in range(0, samples, 500):
+        end = start + 500
+        chunked.feed(timestamps[start:end], latitudes[start:end],
+                     longitudes[start:end], heart_rates[start:end])
+    distance = 6371.0 * math.radians(0.09)
+    assert chunked.get_distance() == pytest.approx(distance, rel=1e-9)
+    assert chunked.get_mean_speed() == pytest.approx(distance, rel=1e-9)
+    kcal = (-55.0969 + 0.6309 * 150 + 0.1988 * 75 + 0.2017 * 30) / 4.184 * 60
+    assert chunked.get_spent_calories() == pytest.approx(kcal)
+    info = chunked.show_training_info()
+    assert isinstance(info, homework.InfoMessage)
+    assert info.training_type == 'TrackRunning'
+    assert info.get_message() == whole.show_training_info().get_message(), (
+        'Результат не должен зависеть от разбиения отсчётов на куски.'
+    )
+
+
+def test_track_training_invalidates_cache():
+    training = homework.TrackWalking(75, 30)
+    training.feed([0, 60], [55.0, 55.001], [37.0, 37.0])
+    first = training.get_distance()
+    training.feed([120], [55.002], [37.0])
+    assert training.get_distance() == pytest.approx(2 * first)
+    assert training.get_spent_calories() == 0.0
+
+
+def test_track_training_profile_change():
+    samples = ([0, 60, 120], [55.0, 55.001, 55.002], [37.0] * 3, [140, 160, 0])
+    training = homework.TrackRunning(75, 30)
+    training.feed(*samples)
+    before = training.get_spent_calories()
+    training.weight = 100
+    training.age = 40
+    fresh = homework.TrackRunning(100, 40)
+    fresh.feed(*samples)
+    assert training.get_spent_calories() == fresh.get_spent_calories(), (
+        'Калории трека должны следовать за весом и возрастом.'
+    )
+    assert training.get_spent_calories() > before
+
+
+def test_track_training_has_no_kernels():
+    assert homework.TrackRunning.KERNEL is None
+    assert homework.TrackRunning.COEFFICIENTS is None
+    with pytest.raises(TypeError):
+        homework.TrackRunning.get_batch_metrics({}, [])
+    with pytest.raises(TypeError):
+        homework.TrackRunning.get_coefficients()
+
+
+@pytest.mark.parametrize('input_data', BATCH_PACKAGES)
+def test_lazy_info_message(input_data):
+    training = homework.read_package(*input_data)
+    lazy = training.show_training_info(lazy=True)
+    assert isinstance(lazy, homework.InfoMessage)
+    expected = homework.read_package(*input_data).show_training_info()
+    assert lazy.get_message() == expected.get_message(), (
+        'Ленивое сообщение должно печататься так же, как обычное.'
+    )
+
+
+def test_lazy_info_message_computes_on_demand(monkeypatch):
+    expected = homework.Running(15000, 1, 75).show_training_info()
+    training = homework.Running(15000, 1, 75)
+    calls = []
+    for metric, kernel in homework.Running.METRIC_KERNELS.items():
+        def counting_kernel(*args, metric=metric, kernel=kernel):
+            calls.append(metric)
+            return kernel(*args)
+        monkeypatch.setitem(homework.Running.METRIC_KERNELS, metric,
+                            counting_kernel)
+    monkeypatch.setattr(homework.Running, 'KERNEL', None)
+    lazy = training.show_training_info(lazy=True)
+    training.duration = 2
+    assert calls == [], 'Создание сообщения не должно вызывать формулы.'
+    assert lazy.distance == expected.distance
+    assert lazy.distance == expected.distance
+    assert calls == ['distance'], 'Непрочитанные поля не должны считаться.'
+    assert lazy.duration == expected.duration, (
+        'Сообщение должно отражать тренировку на момент создания.'
+    )
+    assert lazy.calories == expected.calories
+    assert lazy.speed == expected.speed
+    assert calls == ['distance', 'calories', 'speed']
+    assert 'training' not in vars(lazy), (
+        'Сообщение не должно держать ссылку на тренировку.'
+    )
+
+
+def test_metric_kernels_skip_unused_formulas():
+    kernels = homework.Running.METRIC_KERNELS
+    assert 'calories' not in kernels['distance'].__code__.co_varnames
+    assert 'calories' not in kernels['speed'].__code__.co_varnames
+    training = homework.Running(15000, 1, 75)
+    assert kernels['speed'](15000, 1, 75) == training.get_mean_speed()
+
+
+def test_process_shared():
+    sources = [BATCH_PACKAGES * 3, BATCH_PACKAGES[:2], BATCH_PACKAGES[3:]]
+    messages = [message.get_message() for message in
+                homework.process_shared(sources, workers=2, batch_size=4)]
+    expected = [message.get_message() for source in sources
+                for message in homework.process_shard(source)]
+    assert sorted(messages) == sorted(expected), (
+        '`process_shared` должен посчитать пакеты всех источников.'
+    )
+
+
+def test_process_shared_back_pressure():
+    consumed = []
+
+    def endless():
+        for package in itertools.cycle(BATCH_PACKAGES):
+            consumed.append(package)
+            yield package
+
+    messages = homework.process_shared([endless()], workers=1, batch_size=4)
+    next(messages)
+    time.sleep(0.5)
+    assert len(consumed) < 100, (
+        'Быстрый источник должен ждать расчёта, а не копить пакеты.'
+    )
+    messages.close()
+    stopped = len(consumed)
+    time.sleep(0.5)
+    assert len(consumed) <= stopped + 1, (
+        'После закрытия результата источник не должен читаться.'
+    )
+
+
+def test_process_shared_error():
+    with pytest.raises(homework.UnknownWorkoutError):
+        list(homework.process_shared([[('NSW', [2, 3, 4, 1])]], workers=1))